@@ -16,11 +16,99 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import {{ module }}
-MODULE = {{ module }}
+import ast
+import os
+import sys
 
-import {{ script}}
-SCRIPTS = [{{ script }}, ]
+try:
+    import cPickle as pickle
+except ImportError:  # Python3
+    import pickle
+
+#: Directory containing this file, and the package's sources
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+#: File storing metadata read by :class:`StaticModule`
+METADATA_CACHE = os.path.join(ROOT_DIR, ".setup_cache", "metadata")
+
+try:
+    _METADATA = pickle.load(open(METADATA_CACHE, "rb"))
+except Exception:  # Missing or unreadable cache
+    _METADATA = {}
+
+
+class StaticModule(object):
+    """Module metadata read from source, without importing the module
+
+    Docstrings and literal dunder assignments such as ``__version__`` are read
+    with :mod:`ast`.  Results are cached in :data:`METADATA_CACHE` keyed on
+    the source's modification time and size.  Any other attribute, including
+    dunder values that aren't literals, imports the real module.
+
+    """
+
+    def __init__(self, name):
+        """Initialise a new ``StaticModule`` object
+
+        :type name: ``str``
+        :param name: Name of module or package
+
+        """
+        self.__name__ = name
+        filename = os.path.join(ROOT_DIR, name, "__init__.py")
+        if not os.path.isfile(filename):
+            filename = os.path.join(ROOT_DIR, "%s.py" % name)
+        self.__file__ = filename
+        self.__dict__.update(read_metadata(filename))
+
+    def __getattr__(self, attr):
+        """Fall back to the imported module for dynamic values
+
+        :type attr: ``str``
+        :param attr: Attribute to fetch
+
+        """
+        __import__(self.__name__)
+        return getattr(sys.modules[self.__name__], attr)
+
+
+def read_metadata(filename):
+    """Read docstring and literal dunder attributes from a Python file
+
+    :type filename: ``str``
+    :param filename: Python file to read
+    :rtype: ``dict``
+    :return: Attribute values keyed by name
+
+    """
+    status = os.stat(filename)
+    key = (status.st_mtime, status.st_size)
+    if filename in _METADATA and _METADATA[filename][0] == key:
+        return _METADATA[filename][1]
+    tree = ast.parse(open(filename).read(), filename)
+    values = {"__doc__": ast.get_docstring(tree, False)}
+    for node in tree.body:
+        if not isinstance(node, ast.Assign) or not len(node.targets) == 1 \
+            or not isinstance(node.targets[0], ast.Name):
+            continue
+        name = node.targets[0].id
+        if name.startswith("__") and name.endswith("__"):
+            try:
+                values[name] = ast.literal_eval(node.value)
+            except ValueError:  # Dynamic value, left for import
+                values.pop(name, None)
+    _METADATA[filename] = (key, values)
+    try:
+        if not os.path.isdir(os.path.dirname(METADATA_CACHE)):
+            os.makedirs(os.path.dirname(METADATA_CACHE))
+        pickle.dump(_METADATA, open(METADATA_CACHE, "wb"), 2)
+    except (IOError, OSError):  # Read-only source tree
+        pass
+    return values
+
+
+MODULE = StaticModule("{{ module }}")
+
+SCRIPTS = [StaticModule("{{ script }}"), ]
 
 ENTRY_POINTS = {
     'console_scripts': [],
@@ -267,9 +355,6 @@ CLASSIFIERS = [
     'Programming Language :: Prolog',
     'Programming Language :: Python',
     'Programming Language :: Python :: 2',
-    'Programming Language :: Python :: 2.3',
-    'Programming Language :: Python :: 2.4',
-    'Programming Language :: Python :: 2.5',
     'Programming Language :: Python :: 2.6',
     'Programming Language :: Python :: 2.7',
     'Programming Language :: Python :: 3',
@@ -49,7 +49,9 @@ copyright = u'2011, James Rowe'
 #
 root_dir = os.path.sep.join(os.path.realpath(__file__).split(os.path.sep)[:-2])
 sys.path.insert(0, root_dir)
-from {{ module }} import __version__
+# Read from source, importing {{ module }} isn't necessary for its version
+from __pkg_data__ import MODULE
+__version__ = MODULE.__version__
 # The short X.Y version.
 version = ".".join(__version__.split(".")[:2])
 # The full version, including alpha/beta/rc tags.
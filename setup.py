@@ -16,21 +16,30 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import doctest
+import atexit
+import fnmatch
 import os
+import re
+import select
 import shutil
+import signal
+import stat
+import struct
 import sys
+import threading
 import time
+import traceback
+import zlib
 
 from setuptools import setup
 from setuptools.command.sdist import (finders, sdist)
 from setuptools import Command
+from setuptools.dist import Distribution
 from distutils.util import convert_path
 
-from distutils.archive_util import make_archive
 from distutils.command.clean import clean
-from distutils.dep_util import newer
-from distutils.errors import (DistutilsFileError, DistutilsModuleError)
+from distutils.errors import (DistutilsFileError, DistutilsModuleError,
+                              DistutilsOptionError)
 from distutils.file_util import write_file
 from distutils.util import execute
 
@@ -39,74 +48,300 @@ try:
 except ImportError:  # Python2.4
     from email.Utils import parseaddr
 
+from binascii import (hexlify, unhexlify)
+from functools import wraps
 from glob import glob
+from hashlib import sha1
 
 try:
-    from subprocess import check_call
-except ImportError:  # Python2.4
-    from subprocess import call as sp_call
+    from cStringIO import StringIO
+except ImportError:  # Python3
+    from io import StringIO
 
-    def check_call(*args, **kwargs):
-        retval = sp_call(*args, **kwargs)
-        if retval:
-            raise OSError("Command execution failed!")
+from io import BytesIO
 
-from subprocess import (PIPE, Popen)
+try:
+    import cPickle as pickle
+except ImportError:  # Python3
+    import pickle
 
 try:
-    from docutils.core import publish_cmdline
-    from docutils import nodes
-    from docutils.parsers.rst import directives
-    #: True if ``docutils`` module is available
-    DOCUTILS = True
+    from importlib import reload
 except ImportError:
-    DOCUTILS = False
+    try:
+        from imp import reload
+    except ImportError:  # Python2, where reload is a builtin
+        pass
+
 try:
-    from pygments import highlight
+    from thread import get_ident
+except ImportError:  # Python3
+    from _thread import get_ident
+
+
+class LazyImport(object):
+    """Availability flag for optional modules, imported on first test
+
+    Commands that don't need an optional module, for example ``clean``, don't
+    pay the cost of importing it.
+
+    """
+
+    def __init__(self, loader):
+        """Initialise a new ``LazyImport`` object
+
+        :type loader: ``function``
+        :param loader: Function to import the modules, raising
+            :exc:`ImportError` if they're unavailable
+
+        """
+        self.loader = loader
+        self.available = None
+
+    def __bool__(self):
+        """Import modules, if they haven't been already
+
+        :rtype: ``bool``
+        :return: True if the modules are available
+
+        """
+        if self.available is None:
+            try:
+                self.loader()
+                self.available = True
+            except ImportError:
+                self.available = False
+        return self.available
+    __nonzero__ = __bool__  # Python2
+
+
+def _import_ctypes():
+    """Import :mod:`ctypes` for :class:`LazyImport`"""
+    global ctypes
+    import ctypes
+    import ctypes.util
+
+
+#: True if ``ctypes`` module is available
+CTYPES = LazyImport(_import_ctypes)
+
+
+def _import_multiprocessing():
+    """Import :mod:`multiprocessing` for :class:`LazyImport`"""
+    global multiprocessing, ThreadPool
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+
+
+#: True if ``multiprocessing`` module is available
+MULTIPROCESSING = LazyImport(_import_multiprocessing)
+
+
+def _import_docutils():
+    """Import :mod:`docutils` for :class:`LazyImport`"""
+    global publish_doctree, publish_from_doctree, FileInput, \
+        docutils_version, nodes, directives
+    from docutils.core import (publish_doctree, publish_from_doctree)
+    from docutils.io import FileInput
+    from docutils import (__version__ as docutils_version, nodes)
+    from docutils.parsers.rst import directives
+
+
+#: True if ``docutils`` module is available
+DOCUTILS = LazyImport(_import_docutils)
+
+
+def _import_pygments():
+    """Import :mod:`pygments` for :class:`LazyImport`"""
+    global pygments_version, highlight, get_lexer_by_name, HtmlFormatter
+    from pygments import (__version__ as pygments_version, highlight)
     from pygments.lexers import get_lexer_by_name
     from pygments.formatters import HtmlFormatter
-    #: True if ``pygments`` module is available
-    PYGMENTS = True
-except ImportError:
-    PYGMENTS = False
+
+
+#: True if ``pygments`` module is available
+PYGMENTS = LazyImport(_import_pygments)
+
+
+def _import_sphinx():
+    """Import Sphinx for :class:`LazyImport`"""
+    global Sphinx
+    from sphinx.application import Sphinx
+
+
+#: True if ``sphinx`` module is available
+SPHINX = LazyImport(_import_sphinx)
+
+
+def _import_lzma():
+    """Import :mod:`lzma` for :class:`LazyImport`"""
+    global lzma
+    import lzma
+
+
+#: True if ``lzma`` module is available
+LZMA = LazyImport(_import_lzma)
 
 import __pkg_data__
-import test
 
 #: Base URL for links
 BASE_URL = "http://jnrowe.github.com/"
 PROJECT_HOMEPAGE = "%s%s" % (BASE_URL, __pkg_data__.MODULE.__name__)
 PROJECT_URL = "https://github.com/JNRowe/%s" % __pkg_data__.MODULE.__name__
+#: Directory for persistent build caches
+CACHE_DIR = ".setup_cache"
+#: File storing SCM query results, see :func:`scm_cache`
+SCM_CACHE = os.path.join(CACHE_DIR, "scm")
+
+#: File storing documentation build inputs, see :func:`doc_inputs`
+DOC_DEPS = os.path.join(CACHE_DIR, "docdeps")
+#: Directory storing parsed documents, see :func:`read_doctree`
+DOCTREE_CACHE = os.path.join(CACHE_DIR, "doctrees")
+#: :mod:`docutils` settings for parsing documents, the footer options are
+#: applied by the reader so must be set here
+PARSER_SETTINGS = {"halt_level": 2, "traceback": False, "source_link": True,
+                   "generator": True}
+#: :mod:`docutils` settings for each writer
+WRITER_SETTINGS = {
+    "html": {"stylesheet_path": "doc/docutils.css",
+             "embed_stylesheet": False},
+    "manpage": {},
+}
+#: Directory storing highlighted code blocks, see :func:`cached_highlight`
+HIGHLIGHT_CACHE = os.path.join(CACHE_DIR, "pygments")
+#: Maximum size of :data:`HIGHLIGHT_CACHE` in bytes
+HIGHLIGHT_CACHE_SIZE = 16 * 1024 * 1024
+#: Unix socket for the documentation build daemon, see
+#: :meth:`BuildDoc.run_server`
+DOC_SERVER = os.path.join(CACHE_DIR, "docserver")
+#: Uncompressed size of independently compressed blocks, see
+#: :class:`ParallelCompressor`
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+#: Directory storing built archives, see :func:`fetch_artifacts`
+ARTIFACT_CACHE = os.path.join(CACHE_DIR, "artifacts")
+#: Maximum size of :data:`ARTIFACT_CACHE` in bytes
+ARTIFACT_CACHE_SIZE = 256 * 1024 * 1024
+#: ChangeLog included in snapshot tarballs, see :meth:`Snapshot.write_tarball`
+SNAPSHOT_CHANGELOG = os.path.join(CACHE_DIR, "ChangeLog")
+#: File storing revisions ChangeLogs were generated from, see
+#: :func:`write_changelog`
+CHANGELOG_STATE = os.path.join(CACHE_DIR, "changelog")
 
-if sys.version_info < (2, 5, 0, 'final'):
-    raise SystemError("Requires Python v2.5+")
+#: SCM query results for the current process, see :func:`scm_cache`
+_SCM_CACHE = {}
+#: Lock for shared SCM state, as queries may run in :class:`ScmQuery` threads
+_SCM_LOCK = threading.RLock()
+#: Subprocesses started by the running command, see :func:`record_process`
+_PROCESS_LOG = {}
+#: Trace output file, owning process and its events, see :func:`trace_span`
+_TRACE = {}
+
+if sys.version_info < (2, 6, 0, 'final'):
+    raise SystemError("Requires Python v2.6+")
 
 
 #{ Generated data file functions
 def write_changelog(filename):
     """Generate a ChangeLog from SCM repo
 
+    If :file:`ChangeLog` was previously generated from an ancestor of the
+    current revision, only the newer changes are rendered and prepended to it.
+
     :type filename: ``str``
     :param filename: Filename to write :file:`ChangeLog` to
 
     """
     if __pkg_data__.SCM == "hg" and os.path.isdir(".hg"):
-        print('Building ChangeLog from Mercurial repository')
+        scm_name = "Mercurial"
         options = "log --no-merges --style changelog"
+        head = call_scm("tip --template {node}", cache=True)
+        newer = "-r tip:%s --prune %s"
+        # The range is empty, not an error, if the revision isn't an ancestor
+        ancestor = ("log -r %s::tip -l 1 --template x", "x")
     elif __pkg_data__.SCM == "git" and os.path.isdir(".git"):
-        print('Building ChangeLog from Git repository')
-        files = call_scm("ls-tree --name-only HEAD")
-        options = "log --graph --date=short --stat -- %s" % " ".join(files)
+        scm_name = "Git"
+        files = iter_scm("ls-tree -z --name-only HEAD", "\0", cache=True)
+        options = "log --graph --date=short --stat %%s -- %s" % " ".join(files)
+        head = call_scm("rev-parse HEAD", cache=True).strip()
+        newer = "%s..HEAD"
+        ancestor = ("merge-base --is-ancestor %s HEAD", "")
     else:
         print("Unable to build ChangeLog, dir is not a %s clone"
               % __pkg_data__.SCM)
         return False
+    state = read_changelog_state()
+    key = os.path.abspath(filename)
+    last = state.get(key)
+    if last and os.path.isfile(filename) \
+        and try_scm(ancestor[0] % last) == ancestor[1]:
+        if last == head:
+            return
+        print('Updating ChangeLog from %s repository' % scm_name)
+        if __pkg_data__.SCM == "hg":
+            options = "%s %s" % (options, newer % (last, last))
+        else:
+            options = options % (newer % last)
+        try:
+            call_scm(options, stdout=open(filename + ".new", "w"))
+            if __pkg_data__.SCM == "hg":
+                headers = [line for line in open(filename + ".new")
+                           if line[:1].isdigit()]
+                output = open(filename + ".new", "a")
+                lines = open(filename)
+                # Entries are grouped by date and author, so merge the group
+                # split by the update
+                if headers and next(lines, None) == headers[-1]:
+                    next(lines, None)
+                else:
+                    lines.seek(0)
+                # The previous tip is no longer tagged as such
+                for line in lines:
+                    output.write(line.replace("] [tip]", "]", 1))
+            else:
+                output = open(filename + ".new", "a")
+                shutil.copyfileobj(open(filename), output)
+            output.close()
+            os.rename(filename + ".new", filename)
+        finally:
+            if os.path.exists(filename + ".new"):
+                os.unlink(filename + ".new")
+    else:
+        print('Building ChangeLog from %s repository' % scm_name)
+        if __pkg_data__.SCM == "git":
+            options = options % ""
+        try:
+            call_scm(options, stdout=open(filename, "w"))
+        finally:
+            # Remove the ChangeLog if call_scm() failed
+            if os.stat(filename).st_size == 0:
+                os.unlink(filename)
+    state[key] = head
+    write_changelog_state(state)
+
+
+def read_changelog_state():
+    """Read revisions :file:`ChangeLog` files were last generated from
+
+    :rtype: ``dict``
+    :return: Revisions keyed by absolute :file:`ChangeLog` path
+
+    """
     try:
-        call_scm(options, stdout=open(filename, "w"))
-    finally:
-        # Remove the ChangeLog if call_scm() failed
-        if os.stat(filename).st_size == 0:
-            os.unlink(filename)
+        return pickle.load(open(CHANGELOG_STATE, "rb"))
+    except Exception:  # Missing or unreadable state
+        return {}
+
+
+def write_changelog_state(state):
+    """Write revisions :file:`ChangeLog` files were last generated from
+
+    :type state: ``dict``
+    :param state: Revisions keyed by absolute :file:`ChangeLog` path
+
+    """
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    pickle.dump(state, open(CHANGELOG_STATE, "wb"), 2)
 
 
 def write_manifest(files):
@@ -121,307 +356,3128 @@ def write_manifest(files):
 
 
 #{ Implementation utilities
-def call_scm(options, *args, **kwargs):
-    """SCM command line tools
+def scm_args(options):
+    """Generate SCM command line
 
-    :type options: ``list``
+    :type options: ``str``
     :param options: SCM command options
-    :type args: ``list``
-    :param args: Positional arguments for ``subprocess.Popen``
-    :type kwargs: ``dict``
-    :param kwargs: Keyword arguments for ``subprocess.Popen``
-    :rtype: ``str``
-    :return: SCM command output
-    :raise OSError: SCM command not found
+    :rtype: ``list``
+    :return: SCM command line
     :raise ValueError: Unknown SCM type
 
     """
     options = options.split()
-    if "stdout" in kwargs:
-        redirect = True
-    else:
-        redirect = False
-        kwargs["stdout"] = PIPE
     if __pkg_data__.SCM in ("hg", "git"):
         options.insert(0, __pkg_data__.SCM)
     else:
         raise ValueError("Unknown SCM type %r" % (__pkg_data__.SCM, ))
+    return options
+
+
+def open_scm(options, *args, **kwargs):
+    """Start SCM command
+
+    :type options: ``list``
+    :param options: SCM command line
+    :type args: ``list``
+    :param args: Positional arguments for ``subprocess.Popen``
+    :type kwargs: ``dict``
+    :param kwargs: Keyword arguments for ``subprocess.Popen``
+    :rtype: ``subprocess.Popen``
+    :return: SCM process
+    :raise OSError: SCM command not found
+
+    """
+    from subprocess import Popen
     try:
-        process = Popen(options, *args, **kwargs)
+        return Popen(options, *args, **kwargs)
     except OSError:
         print("Error calling %r, is %s installed?"
               % (options[0], __pkg_data__.SCM))
         raise
-    process.wait()
-    if not process.returncode == 0:
-        print("%r completed with %i return code"
-              % (options[0], process.returncode))
-        sys.exit(process.returncode)
-    if redirect:
-        return True
-    else:
-        return process.stdout.read()
 
 
-def gen_desc(doc):
-    """Pull simple description from docstring
+def record_process(options, start):
+    """Record a completed subprocess for :class:`TimedDistribution`
 
-    :type doc: ``str``
-    :param doc: Docstring to manipulate
-    :rtype: ``str``
-    :return: Description string suitable for :class:`Command` class's
-        description
+    :type options: ``list``
+    :param options: Command line
+    :type start: ``float``
+    :param start: Time the process was started
 
     """
-    desc = doc.splitlines()[0].lstrip()
-    return desc[0].lower() + desc[1:]
+    records = _PROCESS_LOG.get("records")
+    if records is not None:
+        records.append((" ".join(options[:2]), time.time() - start))
+    trace_span(" ".join(options), "subprocess", start)
 
 
-class NoOptsCommand(Command):
-    """Abstract class for simple :mod:`distutils` command implementation"""
+def start_trace(filename):
+    """Start recording ``--trace`` events
 
-    def initialize_options(self):
-        """Set default values for options"""
-        pass
+    :type filename: ``str``
+    :param filename: Chrome trace event file to write
 
-    def finalize_options(self):
-        """Finalize, and test validity, of options"""
-        pass
-#}
+    """
+    # Drop worker events left by an interrupted run
+    for part in glob("%s.*.events" % filename):
+        os.unlink(part)
+    _TRACE.update(filename=filename, pid=os.getpid(), events=[])
 
 
-class BuildDoc(NoOptsCommand):
-    """Build project documentation
+def trace_span(name, category, start, args=None):
+    """Record a completed span for ``--trace``
 
-    .. attribute:: force
+    Worker processes append their events to a per-process file, which
+    :func:`write_trace` merges in to the owning process's events.
 
-       Force documentation generation
+    :type name: ``str``
+    :param name: Span name
+    :type category: ``str``
+    :param category: Span category
+    :type start: ``float``
+    :param start: Time the span started
+    :type args: ``dict``
+    :param args: Extra data to display with the span
 
     """
-    description = gen_desc(__doc__)
-    #: `BuildDoc`'s option mapping
-    user_options = [
-        ('force', 'f',
-         "force documentation generation"),
-    ]
-    #: `BuildDoc` class' boolean options
-    boolean_options = ['force']
+    if not _TRACE:
+        return
+    now = time.time()
+    event = {"name": name, "cat": category, "ph": "X",
+             "ts": int(start * 1000000), "dur": int((now - start) * 1000000),
+             "pid": os.getpid(), "tid": get_ident()}
+    if args:
+        event["args"] = args
+    if event["pid"] == _TRACE["pid"]:
+        _TRACE["events"].append(event)
+    else:
+        import json
+        open("%s.%i.events" % (_TRACE["filename"], event["pid"]),
+             "a").write(json.dumps(event) + "\n")
 
-    def initialize_options(self):
-        """Set default values for options"""
-        self.force = False
 
-    def run(self):
-        """Build the required documentation"""
-        if not DOCUTILS:
-            raise DistutilsModuleError("docutils import failed, "
-                                       "can't generate documentation")
-        if not PYGMENTS:
-            # This could be a warning with conditional support for users, but
-            # how would coloured output be guaranteed in releases?
-            raise DistutilsModuleError("pygments import failed, "
-                                       "can't generate documentation")
+def traced(category, arg=None):
+    """Decorator recording calls as ``--trace`` spans
 
-        def pygments_directive(name, arguments, options, content, lineno,
-                               content_offset, block_text, state,
-                               state_machine):
-            """Code colourising directive for :mod:`docutils`"""
-            # Previously we tested to see if the lexer existed and set a
-            # default of text if it didn't, but this hides bugs such as a typo
-            # in the directive
-            lexer = get_lexer_by_name(arguments[0])
-            if sys.version_info[:2] >= (3, 0):
-                parsed = highlight('\n'.join(content), lexer,
-                                   pygments_formatter)
-            else:
-                parsed = highlight(unicode('\n'.join(content)), lexer,
-                                   HtmlFormatter())
-            return [nodes.raw('', parsed, format='html')]
-        pygments_directive.arguments = (1, 0, 1)
-        pygments_directive.content = 1
-        directives.register_directive('code-block', pygments_directive)
+    :type category: ``str``
+    :param category: Span category
+    :type arg: ``int``
+    :param arg: Index of the positional argument to include in span names
+    :rtype: ``function``
+    :return: Decorator for functions to trace
 
-        for source in sorted(["NEWS.rst", "README.rst"] + glob('doc/*.rst')):
-            dest = os.path.splitext(source)[0] + '.html'
-            if self.force or newer(source, dest):
-                print('Building file %s' % dest)
-                if self.dry_run:
-                    continue
-                publish_cmdline(writer_name='html',
-                                argv=['--source-link', '--strict',
-                                      '--generator',
-                                      '--stylesheet-path=doc/docutils.css',
-                                      '--link-stylesheet', source, dest])
-        print("Building sphinx tree")
-        if not os.path.isdir("doc/html"):
-            os.mkdir("doc/html")
-        check_call(["sphinx-build", "-b", "html", "-d", "doc/source/.doctrees",
-                    "doc/source", "doc/html"])
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _TRACE:
+                return func(*args, **kwargs)
+            name = func.__name__
+            if arg is not None and len(args) > arg:
+                name = "%s %s" % (name, args[arg])
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                trace_span(name, category, start)
+        return wrapper
+    return decorator
 
-        files = glob("%s/*.py" % __pkg_data__.MODULE.__name__)
-        files.extend(["%s.py" % i.__name__ for i in __pkg_data__.SCRIPTS])
-        if self.force or not os.path.isfile("ChangeLog"):
-            execute(write_changelog, ("ChangeLog", ))
+
+def write_trace():
+    """Write recorded ``--trace`` events in Chrome trace event format"""
+    import json
+    events = _TRACE["events"]
+    for part in glob("%s.*.events" % _TRACE["filename"]):
+        events.extend([json.loads(line) for line in open(part)])
+        os.unlink(part)
+    names = []
+    for pid in sorted(set([event["pid"] for event in events])):
+        if pid == _TRACE["pid"]:
+            name = "setup.py"
         else:
-            cl_time = os.stat("ChangeLog").st_mtime
-            if __pkg_data__.SCM == "hg" and os.path.isdir(".hg"):
-                output = call_scm("tip --template '{date}'")
-                tip_time = float(output[1:output.find("-")])
-            elif __pkg_data__.SCM == "git" and os.path.isdir(".git"):
-                output = call_scm("log -n 1 --pretty=format:%at HEAD")
-                tip_time = int(output)
-            else:
-                print("Unable to build ChangeLog, dir is not a %s clone"
-                      % __pkg_data__.SCM)
-                return False
-            if tip_time > cl_time:
-                execute(write_changelog, ("ChangeLog", ))
+            name = "worker %i" % pid
+        names.append({"name": "process_name", "ph": "M", "pid": pid,
+                      "tid": 0, "args": {"name": name}})
+    temp = "%s.%i" % (_TRACE["filename"], os.getpid())
+    json.dump({"traceEvents": names + events, "displayTimeUnit": "ms"},
+              open(temp, "w"))
+    os.rename(temp, _TRACE["filename"])
 
-        if hasattr(__pkg_data__, "BuildDoc_run"):
-            __pkg_data__.BuildDoc_run(self.dry_run, self.force)
 
+def scm_state():
+    """Identify repository state for SCM query caching
 
-#{ Distribution utilities
-def scm_finder(*none):
-    """Find files for distribution tarball
+    The state covers the current head, the revision it resolves to and the
+    stat data of the index or dirstate, any change to these invalidates cached
+    results.
 
-    This is only used when ``setuptools`` is imported, simply to create a valid
-    list of files to distribute.  Standard setuptools only works with CVS.
-    Without this it *appears* to work, but only distributes a very small subset
-    of the package.
+    :rtype: ``str``
+    :return: Repository state, or ``None`` if state can't be determined
 
-    .. seealso::
+    """
+    if __pkg_data__.SCM == "hg" and os.path.isdir(".hg"):
+        files = [".hg/dirstate", ".hg/store/00changelog.i", ".hg/bookmarks"]
+        state = []
+    elif __pkg_data__.SCM == "git" and os.path.isdir(".git"):
+        files = [".git/index", ".git/packed-refs"]
+        head = open(".git/HEAD").read()
+        state = [head]
+        if head.startswith("ref: "):
+            ref = os.path.join(".git", head[5:].strip())
+            if os.path.isfile(ref):
+                state.append(open(ref).read())
+    else:
+        return None
+    for filename in files:
+        try:
+            info = os.stat(filename)
+        except OSError:
+            state.append("%s missing" % filename)
+        else:
+            state.append("%s %r %i %i" % (filename, info.st_mtime,
+                                          info.st_size, info.st_ino))
+    return "\n".join(state)
 
-       :class:`MySdist.get_file_list`
 
-    :type none: any
-    :param none: Just for compatibility
-    """
-    # setuptools documentation says this shouldn't be a hard fail, but we won't
-    # do that as it makes builds entirely unpredictable
-    if __pkg_data__.SCM == "hg":
-        output = call_scm("locate")
-    elif __pkg_data__.SCM == "git":
-        output = call_scm("ls-tree -r --full-name --name-only HEAD")
-    distributed_files = output.splitlines()
-    distributed_files.append(".%s_version" % __pkg_data__.SCM)
-    distributed_files.append("ChangeLog")
-    distributed_files.extend(glob("*.html"))
-    distributed_files.extend(glob("doc/*.html"))
-    for path, directory, filenames in os.walk("html"):
-        for filename in filenames:
-            distributed_files.append(os.path.join(path, filename))
-    return distributed_files
-    if __pkg_data__.SCM == "hg":
-        finders.append((convert_path('.hg/dirstate'), scm_finder))
-    elif __pkg_data__.SCM == "git":
-        finders.append((convert_path('.git/index'), scm_finder))
+def scm_cache():
+    """Fetch SCM query results for the current repository state
 
+    Results are held in memory for the current process, and persisted in
+    :data:`SCM_CACHE` for future runs.
 
-class ScmSdist(sdist):
-    """Create a source distribution tarball
+    :rtype: ``dict``
+    :return: SCM query results, or ``None`` if caching isn't possible
 
-    .. seealso::
+    """
+    state = scm_state()
+    if state is None:
+        return None
+    _SCM_LOCK.acquire()
+    try:
+        if not _SCM_CACHE.get("state") == state:
+            _SCM_CACHE.clear()
+            _SCM_CACHE.update(state=state, results={})
+            try:
+                stored = pickle.load(open(SCM_CACHE, "rb"))
+            except Exception:  # Missing or unreadable cache
+                pass
+            else:
+                if stored["state"] == state:
+                    _SCM_CACHE["results"] = stored["results"]
+        return _SCM_CACHE["results"]
+    finally:
+        _SCM_LOCK.release()
 
-       :class:`sdist`
 
-    .. attribute: repo
+def store_scm_cache(key, result):
+    """Store SCM query result
 
-       SCM repository object
+    :type key: ``tuple``
+    :param key: Query identifier
+    :param result: Query result
 
     """
-    description = gen_desc(__doc__)
-    #: `ScmSdist`'s option mapping
-    user_options = [
-        ('force-build', 'b', "force build with stale version number"),
-    ] + sdist.user_options
-    boolean_options = ['force-build']
+    _SCM_LOCK.acquire()
+    try:
+        results = scm_cache()
+        if results is None:
+            return
+        results[key] = result
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        pickle.dump(_SCM_CACHE, open(SCM_CACHE, "wb"), 2)
+    finally:
+        _SCM_LOCK.release()
 
-    def initialize_options(self):
-        """Set default values for options"""
-        sdist.initialize_options(self)
-        self.force_build = False
-        if __pkg_data__.SCM == "hg":
-            output = call_scm("status -mard")
-        elif __pkg_data__.SCM == "git":
-            output = call_scm("diff --name-status")
-        else:
-            raise ValueError("Unknown SCM type %r" % (__pkg_data__.SCM, ))
-        if not len(output) == 0:
-            raise DistutilsFileError("Uncommitted changes!")
 
-    def get_file_list(self):
-        """Generate MANIFEST file contents from SCM"""
-        manifest_files = scm_finder()
-        execute(write_manifest, [manifest_files], "writing MANIFEST")
-        sdist.get_file_list(self)
+def check_scm(options, returncode):
+    """Exit if SCM command failed
 
-    def make_distribution(self):
-        """Update versioning data and build distribution"""
-        news_format = "%s - " % __pkg_data__.MODULE.__version__
-        news_matches = [line for line in open("NEWS.rst")
-                        if line.startswith(news_format)]
-        if not any(news_matches):
-            print("NEWS.rst entry for %r missing"
-                  % (__pkg_data__.MODULE.__version__, ))
-            sys.exit(1)
-        news_time = time.mktime(time.strptime(news_matches[0].split()[-1],
-                                "%Y-%m-%d"))
-        if time.time() - news_time > 86400 and not self.force_build:
-            print("NEWS.rst entry is older than a day, version may not have "
-                  "been updated")
-            sys.exit(1)
-        execute(self.write_version, ())
-        sdist.make_distribution(self)
+    :type options: ``list``
+    :param options: SCM command line
+    :type returncode: ``int``
+    :param returncode: SCM command's return code
 
-    def write_version(self):
-        """Store the current SCM changeset identifier in a file"""
-        if __pkg_data__.SCM == "hg":
-            # This could use `hg identify' but that outputs other unused
-            # information
-            output = call_scm("tip --template '{node|short}'")[1:-1]
-        elif __pkg_data__.SCM == "git":
-            output = call_scm("log -n 1 --pretty=format:%T HEAD")
-        else:
-            raise ValueError("Unknown SCM type %r" % (__pkg_data__.SCM, ))
-        write_file(".%s_version" % __pkg_data__.SCM, (output, ))
+    """
+    if not returncode == 0:
+        print("%r completed with %i return code" % (options[0], returncode))
+        sys.exit(returncode)
 
 
-class Snapshot(NoOptsCommand):
-    """Build a daily snapshot tarball"""
-    description = gen_desc(__doc__)
-    #: `Snapshot`'s option mapping
-    user_options = []
+class HgCommandServer(object):
+    """Persistent :command:`hg` command server connection
 
-    def run(self):
-        """Prepare and create tarball"""
-        snapshot_name = "%s-%s" % (__pkg_data__.MODULE.__name__,
-                                   time.strftime("%Y-%m-%d"))
-        snapshot_location = "dist/%s" % snapshot_name
-        if os.path.isdir(snapshot_location):
-            execute(shutil.rmtree, (snapshot_location, ))
-        execute(self.generate_tree, (snapshot_location, ))
-        execute(write_changelog, ("%s/ChangeLog" % snapshot_location, ))
-        execute(make_archive, (snapshot_location, "bztar", "dist",
-                               snapshot_name))
-        execute(shutil.rmtree, (snapshot_location, ))
+    Commands are sent to a single :command:`hg serve --cmdserver pipe` process,
+    avoiding the interpreter startup cost of running :command:`hg` for each
+    query.
 
-    @staticmethod
-    def generate_tree(snapshot_name):
-        """Generate a clean SCM clone"""
+    """
+
+    def __init__(self, command=("hg", "serve", "--cmdserver", "pipe")):
+        """Initialise a new `HgCommandServer` object
+
+        :type command: ``tuple``
+        :param command: Command line to start server with
+        :raise ValueError: Server doesn't support ``runcommand``
+
+        """
+        from subprocess import PIPE
+        self.process = open_scm(list(command), stdin=PIPE, stdout=PIPE)
+        self.lock = threading.Lock()
+        channel, data = self.read_channel()
+        hello = dict([line.split(b": ", 1) for line in data.splitlines()])
+        if not channel == b"o" \
+            or not b"runcommand" in hello.get(b"capabilities", b"").split():
+            self.close()
+            raise ValueError("Unsupported command server")
+        self.encoding = text(hello.get(b"encoding", b"UTF-8"))
+
+    def read_channel(self):
+        """Read a message from the server
+
+        :rtype: ``tuple``
+        :return: Channel and data, or the requested length for input channels
+        :raise EOFError: Server exited
+
+        """
+        header = self.process.stdout.read(5)
+        if not len(header) == 5:
+            raise EOFError("Command server exited")
+        channel, length = struct.unpack(">cI", header)
+        if channel in b"IL":
+            return channel, length
+        return channel, self.process.stdout.read(length)
+
+    def runcommand(self, args, stdout=None):
+        """Run a command in the server
+
+        :type args: ``list``
+        :param args: Command arguments
+        :type stdout: ``file``
+        :param stdout: File to write output to, instead of returning it
+        :rtype: ``tuple``
+        :return: Return code and output
+
+        """
+        data = b"\0".join([arg.encode(self.encoding) for arg in args])
+        output = []
+        self.lock.acquire()
+        try:
+            self.process.stdin.write(b"runcommand\n"
+                                     + struct.pack(">I", len(data)) + data)
+            self.process.stdin.flush()
+            while True:
+                channel, data = self.read_channel()
+                if channel == b"o":
+                    if stdout:
+                        stdout.write(data.decode(self.encoding))
+                    else:
+                        output.append(data)
+                elif channel == b"e":
+                    sys.stderr.write(data.decode(self.encoding))
+                elif channel == b"r":
+                    returncode = struct.unpack(">i", data)[0]
+                    break
+                elif channel in b"IL":
+                    # Commands are non-interactive, so signal end of input
+                    self.process.stdin.write(struct.pack(">I", 0))
+                    self.process.stdin.flush()
+                elif channel.isupper():
+                    raise ValueError("Unsupported required channel %r"
+                                     % channel)
+        finally:
+            self.lock.release()
+        return returncode, b"".join(output).decode(self.encoding)
+
+    def close(self):
+        """Shut down the server"""
+        self.process.stdin.close()
+        self.process.wait()
+
+
+#: Command server for this run, see :func:`hg_server`
+_HG_SERVER = {}
+
+
+def hg_server():
+    """Fetch the :command:`hg` command server for this run
+
+    :rtype: `HgCommandServer`
+    :return: Command server, or ``None`` if not using :command:`hg` or the
+        server is unsupported
+
+    """
+    # Queries run in concurrent `ScmQuery` threads, which must share a server
+    _SCM_LOCK.acquire()
+    try:
+        if not "server" in _HG_SERVER:
+            server = None
+            if __pkg_data__.SCM == "hg":
+                try:
+                    server = HgCommandServer()
+                except (EOFError, ValueError):  # Unsupported by hg version
+                    pass
+                else:
+                    atexit.register(server.close)
+            _HG_SERVER["server"] = server
+        return _HG_SERVER["server"]
+    finally:
+        _SCM_LOCK.release()
+
+
+@traced("scm", 0)
+def call_scm(options, *args, **kwargs):
+    """SCM command line tools
+
+    :type options: ``str``
+    :param options: SCM command options
+    :type args: ``list``
+    :param args: Positional arguments for ``subprocess.Popen``
+    :type kwargs: ``dict``
+    :param kwargs: Keyword arguments for ``subprocess.Popen``, and ``cache``
+        to reuse results while repository state is unchanged
+    :rtype: ``str``
+    :return: SCM command output
+    :raise OSError: SCM command not found
+    :raise ValueError: Unknown SCM type
+
+    .. seealso::
+
+       :func:`iter_scm`, :func:`native_scm`, :func:`scm_cache`
+
+    """
+    cache = kwargs.pop("cache", False) and not args and not kwargs
+    if cache:
+        key = ("call", options)
+        results = scm_cache()
+        if results and key in results:
+            return results[key]
+    if not args and not kwargs:
+        output = native_scm(options)
+        if output is not None:
+            if cache:
+                store_scm_cache(key, output)
+            return output
+    redirect = "stdout" in kwargs
+    server = not args and set(kwargs).issubset(["stdout"]) and hg_server()
+    options = scm_args(options)
+    start = time.time()
+    if server:
+        returncode, output = server.runcommand(options[1:],
+                                               kwargs.get("stdout"))
+    else:
+        if not redirect:
+            from subprocess import PIPE
+            kwargs["stdout"] = PIPE
+            # Return text, not bytes, on Python 3
+            kwargs.setdefault("universal_newlines", True)
+        process = open_scm(options, *args, **kwargs)
+        # Read before waiting, large output would otherwise fill the pipe
+        output = process.communicate()[0]
+        returncode = process.returncode
+    record_process(options, start)
+    check_scm(options, returncode)
+    if redirect:
+        return True
+    else:
+        if cache:
+            store_scm_cache(key, output)
+        return output
+
+
+def try_scm(options):
+    """Run SCM command, without exiting on failure
+
+    :type options: ``str``
+    :param options: SCM command options
+    :rtype: ``str``
+    :return: SCM command output, or ``None`` if the command failed
+
+    """
+    from subprocess import PIPE
+    options = scm_args(options)
+    start = time.time()
+    process = open_scm(options, stdout=PIPE, stderr=PIPE,
+                       universal_newlines=True)
+    output = process.communicate()[0]
+    record_process(options, start)
+    if not process.returncode == 0:
+        return None
+    return output
+
+
+def read_records(stream, separator):
+    """Stream records from a file
+
+    >>> list(read_records(StringIO("a\\0bc\\0\\0d\\0"), "\\0"))
+    ['a', 'bc', '', 'd']
+
+    :type stream: ``file``
+    :param stream: File to read from
+    :type separator: ``str``
+    :param separator: Record separator
+    :rtype: ``generator``
+    :return: Records, without separators
+
+    """
+    buffered = ""
+    while True:
+        chunk = stream.read(65536)
+        if not chunk:
+            break
+        records = (buffered + chunk).split(separator)
+        buffered = records.pop()
+        for record in records:
+            yield record
+    if buffered:
+        yield buffered
+
+
+def iter_scm(options, separator="\n", *args, **kwargs):
+    """Stream SCM command output
+
+    Records are yielded as the command produces them, so memory use is bounded
+    by the largest record instead of the complete output.  If the generator is
+    closed early the SCM command is killed.  Cached output is written to a
+    file in :data:`CACHE_DIR` as it is yielded, and streamed back from there.
+
+    :type options: ``str``
+    :param options: SCM command options
+    :type separator: ``str``
+    :param separator: Record separator, for example ``"\\0"`` for ``-z`` output
+    :type args: ``list``
+    :param args: Positional arguments for ``subprocess.Popen``
+    :type kwargs: ``dict``
+    :param kwargs: Keyword arguments for ``subprocess.Popen``, and ``cache``
+        to reuse results while repository state is unchanged
+    :rtype: ``generator``
+    :return: SCM command output records
+    :raise OSError: SCM command not found
+    :raise ValueError: Unknown SCM type
+
+    """
+    cache = kwargs.pop("cache", False) and not args and not kwargs
+    if cache:
+        key = ("iter", options, separator)
+        results = scm_cache()
+        if results and key in results:
+            if isinstance(results[key], list):
+                for record in results[key]:
+                    yield record
+                return
+            try:
+                stored = open(results[key])
+            except IOError:  # Removed since stored, rerun the query
+                pass
+            else:
+                try:
+                    for record in read_records(stored, separator):
+                        yield record
+                finally:
+                    stored.close()
+                return
+    if not args and not kwargs:
+        records = native_scm(options, separator)
+        if records is not None:
+            if cache:
+                store_scm_cache(key, records)
+            for record in records:
+                yield record
+            return
+    options = scm_args(options)
+    start = time.time()
+    if not args and not kwargs and hg_server():
+        returncode, output = hg_server().runcommand(options[1:])
+        record_process(options, start)
+        check_scm(options, returncode)
+        records = output.split(separator)
+        if not records[-1]:
+            records.pop()
+        if cache:
+            store_scm_cache(key, records)
+        for record in records:
+            yield record
+        return
+    from subprocess import PIPE
+    kwargs["stdout"] = PIPE
+    kwargs.setdefault("universal_newlines", True)
+    process = open_scm(options, *args, **kwargs)
+    if cache:
+        filename = os.path.join(CACHE_DIR, "scm-%s"
+                                % sha1(repr(key).encode("utf-8")).hexdigest())
+        # Cached results can only be stored for complete output
+        temp = "%s.%i.%i" % (filename, os.getpid(), get_ident())
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        stored = open(temp, "w")
+    complete = False
+    try:
+        for record in read_records(process.stdout, separator):
+            if cache:
+                stored.write(record + separator)
+            yield record
+        complete = True
+    finally:
+        if not complete and process.poll() is None:
+            process.stdout.close()
+            try:
+                process.kill()
+            except OSError:  # Exited since poll()
+                pass
+        process.wait()
+        record_process(options, start)
+        if cache:
+            stored.close()
+            if not complete or process.returncode:
+                os.unlink(temp)
+    check_scm(options, process.returncode)
+    if cache:
+        os.rename(temp, filename)
+        store_scm_cache(key, filename)
+
+
+class ScmQuery(threading.Thread):
+    """Run an SCM query in a background thread
+
+    Exceptions from the query, including the :exc:`SystemExit` raised when an
+    SCM command fails, are re-raised by :meth:`result` so errors behave as if
+    the query was made directly.
+
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        """Initialise a new `ScmQuery` object, and start the query
+
+        :type func: ``function``
+        :param func: Query function
+        :type args: ``list``
+        :param args: Positional arguments for ``func``
+        :type kwargs: ``dict``
+        :param kwargs: Keyword arguments for ``func``
+
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.output = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        """Run query, storing its result"""
+        try:
+            self.output = self.func(*self.args, **self.kwargs)
+        except BaseException:
+            self.error = sys.exc_info()[1]
+
+    def result(self):
+        """Wait for query to complete
+
+        :return: Query result
+
+        """
+        self.join()
+        if self.error:
+            raise self.error
+        return self.output
+
+
+def gen_desc(doc):
+    """Pull simple description from docstring
+
+    :type doc: ``str``
+    :param doc: Docstring to manipulate
+    :rtype: ``str``
+    :return: Description string suitable for :class:`Command` class's
+        description
+
+    """
+    desc = doc.splitlines()[0].lstrip()
+    return desc[0].lower() + desc[1:]
+
+
+def parse_jobs(jobs):
+    """Normalise a ``--jobs`` option value
+
+    >>> import multiprocessing
+    >>> parse_jobs("4")
+    4
+    >>> parse_jobs("0") == multiprocessing.cpu_count()
+    True
+    >>> try:
+    ...     parse_jobs("auto")
+    ... except DistutilsOptionError:
+    ...     print(sys.exc_info()[1])
+    Invalid job count 'auto'
+
+    :type jobs: ``str`` or ``int``
+    :param jobs: Number of worker processes, ``0`` for one per CPU
+    :rtype: ``int``
+    :return: Number of worker processes to use
+    :raise DistutilsOptionError: Invalid job count
+    :raise DistutilsModuleError: :mod:`multiprocessing` unavailable
+
+    """
+    try:
+        jobs = int(jobs)
+    except ValueError:
+        raise DistutilsOptionError("Invalid job count %r" % (jobs, ))
+    if jobs < 0:
+        raise DistutilsOptionError("Invalid job count %r" % (jobs, ))
+    elif jobs == 0:
+        jobs = MULTIPROCESSING and multiprocessing.cpu_count() or 1
+    if jobs > 1 and not MULTIPROCESSING:
+        raise DistutilsModuleError("multiprocessing import failed, "
+                                   "can't run parallel jobs")
+    return jobs
+
+
+def parse_timeout(timeout):
+    """Normalise a timeout option value
+
+    >>> parse_timeout("1.5")
+    1.5
+    >>> parse_timeout("0") is None
+    True
+    >>> try:
+    ...     parse_timeout("soon")
+    ... except DistutilsOptionError:
+    ...     print(sys.exc_info()[1])
+    Invalid timeout 'soon'
+
+    :type timeout: ``str`` or ``float``
+    :param timeout: Time limit in seconds, ``0`` for no limit
+    :rtype: ``float``
+    :return: Time limit in seconds, or ``None`` for no limit
+    :raise DistutilsOptionError: Invalid timeout
+    :raise DistutilsModuleError: Interval timers unavailable
+
+    """
+    try:
+        timeout = float(timeout)
+    except ValueError:
+        raise DistutilsOptionError("Invalid timeout %r" % (timeout, ))
+    if timeout < 0:
+        raise DistutilsOptionError("Invalid timeout %r" % (timeout, ))
+    elif timeout == 0:
+        return None
+    if not hasattr(signal, "setitimer"):
+        raise DistutilsModuleError("Interval timers unavailable, "
+                                   "can't apply timeouts")
+    return timeout
+
+
+def gzip_compress(data):
+    """Compress data as a single gzip member
+
+    :type data: ``bytes``
+    :param data: Data to compress
+    :rtype: ``bytes``
+    :return: gzip compressed data
+
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def bz2_compress(data):
+    """Compress data as a single bzip2 stream
+
+    :type data: ``bytes``
+    :param data: Data to compress
+    :rtype: ``bytes``
+    :return: bzip2 compressed data
+
+    """
+    import bz2
+    return bz2.compress(data)
+
+
+def xz_compress(data):
+    """Compress data as a single xz stream
+
+    :type data: ``bytes``
+    :param data: Data to compress
+    :rtype: ``bytes``
+    :return: xz compressed data
+    :raise DistutilsModuleError: :mod:`lzma` unavailable
+
+    """
+    if not LZMA:
+        raise DistutilsModuleError("lzma import failed, "
+                                   "can't compress xz tarballs")
+    return lzma.compress(data)
+
+
+#: Block compression functions, keyed by :mod:`tarfile` compression name
+COMPRESSORS = {
+    "bz2": bz2_compress,
+    "gz": gzip_compress,
+    "xz": xz_compress,
+}
+#: :mod:`tarfile` compression names, keyed by :mod:`distutils` archive format
+ARCHIVE_FORMATS = {"bztar": "bz2", "gztar": "gz", "xztar": "xz", "tar": ""}
+
+
+class ParallelCompressor(object):
+    """File-like object compressing blocks of data in parallel
+
+    Written data is split in to blocks of :data:`COMPRESS_BLOCK_SIZE`, which
+    are compressed independently on a thread pool and written in order as
+    concatenated streams.  bzip2, gzip and xz tools all read multi-stream
+    files, so the output is usable anywhere a single stream would be.
+
+    >>> import gzip
+    >>> output = BytesIO()
+    >>> compressor = ParallelCompressor(output, "gz", 2, block_size=4)
+    >>> compressor.write(b"hello ")
+    >>> compressor.write(b"world")
+    >>> compressor.close()
+    >>> compressor.blocks
+    3
+    >>> stream = gzip.GzipFile(fileobj=BytesIO(output.getvalue()))
+    >>> stream.read() == b"hello world"
+    True
+
+    """
+
+    def __init__(self, fileobj, compression, jobs,
+                 block_size=COMPRESS_BLOCK_SIZE):
+        """Initialise a new ``ParallelCompressor`` object
+
+        :type fileobj: ``file``
+        :param fileobj: File to write compressed data to
+        :type compression: ``str``
+        :param compression: Compression name from :data:`COMPRESSORS`
+        :type jobs: ``int``
+        :param jobs: Number of compression threads
+        :type block_size: ``int``
+        :param block_size: Uncompressed size of each block
+        :raise DistutilsOptionError: Unsupported compression
+        :raise DistutilsModuleError: :mod:`multiprocessing` unavailable
+
+        """
+        if not MULTIPROCESSING:
+            raise DistutilsModuleError("multiprocessing import failed, "
+                                       "can't compress in parallel")
+        if not compression in COMPRESSORS:
+            raise DistutilsOptionError("Unsupported compression %r"
+                                       % (compression, ))
+        if compression == "xz" and not LZMA:
+            raise DistutilsModuleError("lzma import failed, "
+                                       "can't compress xz tarballs")
+        self.fileobj = fileobj
+        self.compress = COMPRESSORS[compression]
+        self.jobs = jobs
+        self.block_size = block_size
+        self.pool = ThreadPool(jobs)
+        self.buffer = []
+        self.buffered = 0
+        self.pending = []
+        self.blocks = 0
+
+    def write(self, data):
+        """Queue data for compression
+
+        :type data: ``bytes``
+        :param data: Data to compress
+
+        """
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered < self.block_size:
+            return
+        data = b"".join(self.buffer)
+        offset = 0
+        while len(data) - offset >= self.block_size:
+            self.submit(data[offset:offset + self.block_size])
+            offset += self.block_size
+        self.buffer = [data[offset:]]
+        self.buffered = len(data) - offset
+
+    def submit(self, block):
+        """Compress a block on the thread pool
+
+        :type block: ``bytes``
+        :param block: Data to compress
+
+        """
+        self.pending.append(self.pool.apply_async(self.compress, (block, )))
+        self.blocks += 1
+        # Bound memory use to a couple of blocks per thread
+        while len(self.pending) > 2 * self.jobs:
+            self.fileobj.write(self.pending.pop(0).get())
+
+    def close(self):
+        """Compress remaining data, and write it to the output file
+
+        As with :mod:`tarfile`, the output file is left open.
+
+        """
+        if self.buffered or not self.blocks:
+            self.submit(b"".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        try:
+            for result in self.pending:
+                self.fileobj.write(result.get())
+            self.pending = []
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+
+def open_tarball(filename, compression, jobs=1):
+    """Open a compressed tarball for streamed writing
+
+    :type filename: ``str``
+    :param filename: Tarball to write
+    :type compression: ``str``
+    :param compression: Compression name from :data:`COMPRESSORS`
+    :type jobs: ``int``
+    :param jobs: Number of compression threads, see :class:`ParallelCompressor`
+    :rtype: ``tarfile.TarFile``
+    :return: Tarball open for writing
+
+    """
+    import tarfile
+    if jobs == 1:
+        return tarfile.open(filename, "w|%s" % compression)
+    output = open(filename, "wb")
+    fileobj = ParallelCompressor(output, compression, jobs)
+    tarball = tarfile.open(fileobj=fileobj, mode="w|")
+    close = tarball.close
+
+    def close_all():
+        """Close tarball, and the files :mod:`tarfile` leaves open"""
+        close()
+        fileobj.close()
+        output.close()
+    tarball.close = close_all
+    return tarball
+
+
+class BufferReader(object):
+    """File-like reader for a buffer, sharing its memory
+
+    Each reader has its own position, so one :mod:`mmap` buffer can be read by
+    several archive writers at once.
+
+    >>> reader = BufferReader(b"abcdef")
+    >>> reader.read(2) == b"ab"
+    True
+    >>> reader.read() == b"cdef"
+    True
+    >>> reader.read(2) == b""
+    True
+
+    """
+
+    def __init__(self, data):
+        """Initialise a new ``BufferReader`` object
+
+        :type data: ``bytes`` or ``mmap.mmap``
+        :param data: Buffer to read
+
+        """
+        try:
+            self.view = memoryview(data)
+        except (NameError, TypeError):
+            # Python 2.6 lacks memoryview, and mmap doesn't support it on 2.7
+            self.view = data
+        self.offset = 0
+
+    def read(self, size=-1):
+        """Read data from buffer
+
+        :type size: ``int``
+        :param size: Maximum number of bytes to read, negative for all
+        :rtype: ``bytes``
+        :return: Data read
+
+        """
+        if size < 0:
+            size = len(self.view) - self.offset
+        chunk = self.view[self.offset:self.offset + size]
+        if not isinstance(chunk, bytes):
+            chunk = chunk.tobytes()
+        self.offset += len(chunk)
+        return chunk
+
+
+class ArchiveWriter(object):
+    """Write members to a tarball or zip file with normalised metadata
+
+    Members are owned by root, and are world readable with execute permission
+    kept only where the source file had it.
+
+    """
+
+    def __init__(self, filename, format, compress_jobs=1):
+        """Initialise a new ``ArchiveWriter`` object
+
+        :type filename: ``str``
+        :param filename: Archive to write
+        :type format: ``str``
+        :param format: :mod:`distutils` archive format, ``zip`` or from
+            :data:`ARCHIVE_FORMATS`
+        :type compress_jobs: ``int``
+        :param compress_jobs: Number of compression threads for tarballs
+
+        """
+        import zipfile
+        self.filename = filename
+        if format == "zip":
+            self.tarball = None
+            self.zipfile = zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED)
+        else:
+            compression = ARCHIVE_FORMATS[format]
+            if not compression:
+                compress_jobs = 1
+            self.tarball = open_tarball(filename, compression, compress_jobs)
+
+    def add(self, name, data, mode, mtime):
+        """Add member to archive
+
+        :type name: ``str``
+        :param name: Member name
+        :type data: ``bytes`` or ``mmap.mmap``
+        :param data: File contents, ``None`` for a directory
+        :type mode: ``int``
+        :param mode: Source file's mode
+        :type mtime: ``float``
+        :param mtime: Source file's modification time
+
+        """
+        import tarfile
+        import zipfile
+        if data is None or mode & 0o100:
+            mode = 0o755
+        else:
+            mode = 0o644
+        if self.tarball:
+            member = tarfile.TarInfo(name)
+            member.mtime = int(mtime)
+            member.mode = mode
+            member.uid = member.gid = 0
+            member.uname = member.gname = ""
+            if data is None:
+                member.type = tarfile.DIRTYPE
+                self.tarball.addfile(member)
+            else:
+                member.size = len(data)
+                self.tarball.addfile(member, BufferReader(data))
+        else:
+            if data is None:
+                name += "/"
+                data = b""
+                mode |= stat.S_IFDIR
+            else:
+                mode |= stat.S_IFREG
+            member = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+            member.compress_type = zipfile.ZIP_DEFLATED
+            member.external_attr = mode << 16
+            self.zipfile.writestr(member, data)
+
+    def close(self):
+        """Finish writing archive"""
+        if self.tarball:
+            self.tarball.close()
+        else:
+            self.zipfile.close()
+
+
+def map_file(filename):
+    """Map a file's contents in to memory
+
+    :type filename: ``str``
+    :param filename: File to map
+    :rtype: ``mmap.mmap`` or ``bytes``
+    :return: File contents, ``bytes`` for empty files as they can't be mapped
+
+    """
+    import mmap
+    handle = open(filename, "rb")
+    try:
+        if not os.fstat(handle.fileno()).st_size:
+            return b""
+        return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        handle.close()
+
+
+class NoOptsCommand(Command):
+    """Abstract class for simple :mod:`distutils` command implementation"""
+
+    def initialize_options(self):
+        """Set default values for options"""
+        pass
+
+    def finalize_options(self):
+        """Finalize, and test validity, of options"""
+        pass
+#}
+
+
+#{ Native SCM readers
+def text(data):
+    """Convert repository data to native strings
+
+    :type data: ``bytes``
+    :param data: Data read from repository
+    :rtype: ``str``
+    :return: Native string
+
+    """
+    if str is bytes:
+        return data
+    return data.decode("utf-8")
+
+
+def apply_git_delta(base, delta):
+    """Apply a :command:`git` pack delta
+
+    >>> delta = b"\\x0b\\x0b\\x90\\x06\\x05there"
+    >>> apply_git_delta(b"hello world", delta) == b"hello there"
+    True
+    >>> apply_git_delta(b"hello world", b"\\x0b\\x0b\\x00")
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid delta opcode
+
+    :type base: ``bytes``
+    :param base: Base object data
+    :type delta: ``bytes``
+    :param delta: Delta instructions
+    :rtype: ``bytes``
+    :return: Result of applying ``delta`` to ``base``
+    :raise ValueError: Invalid delta instruction
+
+    """
+    opcodes = bytearray(delta)
+    pos = 0
+    # Skip source and target size headers
+    for _ in range(2):
+        while opcodes[pos] & 0x80:
+            pos += 1
+        pos += 1
+    output = []
+    while pos < len(opcodes):
+        opcode = opcodes[pos]
+        pos += 1
+        if opcode & 0x80:
+            offset = size = 0
+            for bit in range(4):
+                if opcode & (1 << bit):
+                    offset |= opcodes[pos] << (bit * 8)
+                    pos += 1
+            for bit in range(3):
+                if opcode & (0x10 << bit):
+                    size |= opcodes[pos] << (bit * 8)
+                    pos += 1
+            output.append(base[offset:offset + (size or 0x10000)])
+        elif opcode:
+            output.append(delta[pos:pos + opcode])
+            pos += opcode
+        else:
+            raise ValueError("Invalid delta opcode")
+    return b"".join(output)
+
+
+def apply_hg_delta(base, delta):
+    """Apply a :command:`hg` revlog delta
+
+    >>> delta = struct.pack(">lll", 6, 11, 5) + b"there"
+    >>> apply_hg_delta(b"hello world", delta) == b"hello there"
+    True
+
+    :type base: ``bytes``
+    :param base: Base revision text
+    :type delta: ``bytes``
+    :param delta: Delta hunks
+    :rtype: ``bytes``
+    :return: Result of applying ``delta`` to ``base``
+
+    """
+    output = []
+    last = pos = 0
+    while pos < len(delta):
+        start, end, length = struct.unpack(">lll", delta[pos:pos + 12])
+        pos += 12
+        output.extend([base[last:start], delta[pos:pos + length]])
+        pos += length
+        last = end
+    output.append(base[last:])
+    return b"".join(output)
+
+
+class GitReader(object):
+    """Read :command:`git` repository data without spawning processes
+
+    Loose and packed refs and objects are supported, along with version 2 and
+    3 index files.  Anything else raises an exception, and callers should fall
+    back to the :command:`git` command.
+
+    >>> import tempfile
+    >>> path = tempfile.mkdtemp()
+    >>> def store(kind, data):
+    ...     data = kind + (" %i\\0" % len(data)).encode("ascii") + data
+    ...     name = sha1(data).hexdigest()
+    ...     os.makedirs(os.path.join(path, "objects", name[:2]))
+    ...     stored = open(os.path.join(path, "objects", name[:2], name[2:]),
+    ...                   "wb")
+    ...     stored.write(zlib.compress(data))
+    ...     stored.close()
+    ...     return name
+    >>> blob = store(b"blob", b"Hello\\n")
+    >>> subtree = store(b"tree", b"100644 README\\0" + unhexlify(blob))
+    >>> tree = store(b"tree", b"100644 NEWS\\0" + unhexlify(blob)
+    ...              + b"40000 doc\\0" + unhexlify(subtree))
+    >>> commit = store(b"commit", b"tree " + tree.encode("ascii")
+    ...                + b"\\nauthor A <a@example.com> 1300000000 +0000"
+    ...                + b"\\n\\nInitial commit\\n")
+    >>> os.makedirs(os.path.join(path, "refs", "heads"))
+    >>> write_file(os.path.join(path, "HEAD"), ["ref: refs/heads/master"])
+    >>> write_file(os.path.join(path, "refs", "heads", "master"), [commit])
+    >>> reader = GitReader(path)
+    >>> reader.resolve() == commit
+    True
+    >>> reader.names()
+    ['NEWS', 'doc']
+    >>> reader.paths()
+    ['NEWS', 'doc/README']
+    >>> reader.tip_time()
+    '1300000000'
+    >>> shutil.rmtree(path)
+
+    """
+    #: Queries answered by `GitReader`, keyed by :func:`iter_scm` or
+    #: :func:`call_scm` arguments
+    queries = {
+        ("ls-tree -z --name-only HEAD", "\0"): "names",
+        ("ls-tree -r -z --full-name --name-only HEAD", "\0"): "paths",
+        ("log -n 1 --pretty=format:%at HEAD", None): "tip_time",
+        ("log -n 1 --pretty=format:%T HEAD", None): "tree",
+        ("rev-parse HEAD", None): "resolve",
+        ("diff --name-status", "\n"): "changes",
+    }
+
+    def __init__(self, path=".git"):
+        """Initialise a new `GitReader` object
+
+        :type path: ``str``
+        :param path: Location of repository data
+
+        """
+        self.path = path
+        self._packs = None
+        self._files = {}
+
+    def resolve(self, ref="HEAD"):
+        """Resolve a reference to an object name
+
+        :type ref: ``str``
+        :param ref: Reference to resolve
+        :rtype: ``str``
+        :return: Object name
+        :raise KeyError: Unknown reference
+
+        """
+        for _ in range(5):
+            filename = os.path.join(self.path, ref)
+            if os.path.isfile(filename):
+                value = open(filename, "rb").read().strip()
+            else:
+                value = self.packed_refs()[ref]
+            if not value.startswith(b"ref: "):
+                return text(value)
+            ref = text(value[5:])
+        raise KeyError("Reference loop in %r" % ref)
+
+    def packed_refs(self):
+        """Read packed references
+
+        :rtype: ``dict``
+        :return: Object names keyed by reference
+
+        """
+        refs = {}
+        filename = os.path.join(self.path, "packed-refs")
+        if os.path.isfile(filename):
+            for line in open(filename, "rb"):
+                if not line.startswith((b"#", b"^")):
+                    name, ref = line.split()
+                    refs[text(ref)] = name
+        return refs
+
+    def packs(self):
+        """Read pack indexes
+
+        :rtype: ``list``
+        :return: Index data and pack filename for each pack
+
+        """
+        if self._packs is None:
+            self._packs = []
+            for index in glob(os.path.join(self.path, "objects/pack/*.idx")):
+                data = open(index, "rb").read()
+                if not data[:8] == b"\377tOc\0\0\0\2":
+                    raise ValueError("Unsupported pack index %r" % index)
+                self._packs.append((data, index[:-4] + ".pack"))
+        return self._packs
+
+    def object(self, name):
+        """Read an object
+
+        :type name: ``str``
+        :param name: Object name
+        :rtype: ``tuple``
+        :return: Object type and data
+        :raise KeyError: Unknown object
+
+        """
+        filename = os.path.join(self.path, "objects", name[:2], name[2:])
+        if os.path.isfile(filename):
+            data = zlib.decompress(open(filename, "rb").read())
+            header, data = data.split(b"\0", 1)
+            return text(header.split()[0]), data
+        binary = unhexlify(name.encode("ascii"))
+        for index, pack in self.packs():
+            offset = self.pack_offset(index, binary)
+            if offset is not None:
+                return self.pack_object(pack, offset)
+        raise KeyError("Unknown object %r" % name)
+
+    @staticmethod
+    def pack_offset(index, binary):
+        """Find an object's location in a pack
+
+        :type index: ``bytes``
+        :param index: Pack index data
+        :type binary: ``bytes``
+        :param binary: Binary object name
+        :rtype: ``int``
+        :return: Offset in pack, or ``None`` if object isn't in pack
+
+        """
+        fanout = struct.unpack(">256I", index[8:1032])
+        first = bytearray(binary)[0]
+        low = first and fanout[first - 1] or 0
+        high = fanout[first]
+        count = fanout[255]
+        while low < high:
+            middle = (low + high) // 2
+            found = index[1032 + middle * 20:1052 + middle * 20]
+            if found < binary:
+                low = middle + 1
+            elif found > binary:
+                high = middle
+            else:
+                break
+        else:
+            return None
+        pos = 1032 + count * 24 + middle * 4
+        offset = struct.unpack(">I", index[pos:pos + 4])[0]
+        if offset & 0x80000000:
+            pos = 1032 + count * 28 + (offset & 0x7fffffff) * 8
+            offset = struct.unpack(">Q", index[pos:pos + 8])[0]
+        return offset
+
+    def pack_object(self, filename, offset):
+        """Read an object from a pack
+
+        A blob, and a delta against it at a relative offset:
+
+        >>> import tempfile
+        >>> base = zlib.compress(b"hello world")
+        >>> delta = zlib.compress(b"\\x0b\\x0b\\x90\\x06\\x05there")
+        >>> pack = tempfile.NamedTemporaryFile()
+        >>> _ = pack.write(b"PACK\\0\\0\\0\\2\\0\\0\\0\\2"
+        ...                + b"\\x3b" + base
+        ...                + b"\\x6a" + struct.pack("B", 1 + len(base))
+        ...                + delta)
+        >>> pack.flush()
+        >>> reader = GitReader()
+        >>> reader.pack_object(pack.name, 12) == ("blob", b"hello world")
+        True
+        >>> reader.pack_object(pack.name, 13 + len(base)) \\
+        ...     == ("blob", b"hello there")
+        True
+        >>> reader._files.pop(pack.name).close()
+        >>> pack.close()
+
+        :type filename: ``str``
+        :param filename: Pack filename
+        :type offset: ``int``
+        :param offset: Offset of object in pack
+        :rtype: ``tuple``
+        :return: Object type and data
+
+        """
+        if not filename in self._files:
+            self._files[filename] = open(filename, "rb")
+        pack = self._files[filename]
+        pack.seek(offset)
+        byte = bytearray(pack.read(1))[0]
+        kind = (byte >> 4) & 7
+        size = byte & 0x0f
+        shift = 4
+        while byte & 0x80:
+            byte = bytearray(pack.read(1))[0]
+            size |= (byte & 0x7f) << shift
+            shift += 7
+        if kind == 6:  # Delta against object at relative offset
+            byte = bytearray(pack.read(1))[0]
+            base = byte & 0x7f
+            while byte & 0x80:
+                byte = bytearray(pack.read(1))[0]
+                base = ((base + 1) << 7) | (byte & 0x7f)
+            base = offset - base
+        elif kind == 7:  # Delta against named object
+            base = text(hexlify(pack.read(20)))
+        # Read data before resolving bases, as that moves the file position
+        decompressor = zlib.decompressobj()
+        data = []
+        while not decompressor.unused_data:
+            chunk = pack.read(4096)
+            if not chunk:
+                break
+            data.append(decompressor.decompress(chunk))
+        data = b"".join(data)
+        if not len(data) == size:
+            raise ValueError("Corrupt object at %i in %r" % (offset, filename))
+        if kind == 6:
+            kind, base = self.pack_object(filename, base)
+            return kind, apply_git_delta(base, data)
+        elif kind == 7:
+            kind, base = self.object(base)
+            return kind, apply_git_delta(base, data)
+        return ("commit", "tree", "blob", "tag")[kind - 1], data
+
+    def commit(self, ref="HEAD"):
+        """Read commit headers
+
+        :type ref: ``str``
+        :param ref: Reference to commit
+        :rtype: ``dict``
+        :return: Commit header values
+
+        """
+        kind, data = self.object(self.resolve(ref))
+        if not kind == "commit":
+            raise ValueError("%r is not a commit" % ref)
+        headers = {}
+        for line in data.split(b"\n\n", 1)[0].splitlines():
+            if not line.startswith(b" "):
+                key, value = line.split(b" ", 1)
+                headers.setdefault(text(key), text(value))
+        return headers
+
+    def ls_tree(self, name, recursive=False, prefix=b""):
+        """List tree contents
+
+        :type name: ``str``
+        :param name: Tree object name
+        :type recursive: ``bool``
+        :param recursive: Recurse in to subtrees
+        :type prefix: ``bytes``
+        :param prefix: Path prefix for entries
+        :rtype: ``generator``
+        :return: Paths of entries, in :command:`git ls-tree` order
+
+        """
+        data = self.object(name)[1]
+        pos = 0
+        while pos < len(data):
+            space = data.index(b" ", pos)
+            nul = data.index(b"\0", space)
+            path = prefix + data[space + 1:nul]
+            if recursive and data[pos:space] == b"40000":
+                subtree = text(hexlify(data[nul + 1:nul + 21]))
+                for entry in self.ls_tree(subtree, True, path + b"/"):
+                    yield entry
+            else:
+                yield text(path)
+            pos = nul + 21
+
+    def names(self):
+        """:command:`git ls-tree -z --name-only HEAD` equivalent"""
+        return list(self.ls_tree(self.tree()))
+
+    def paths(self):
+        """:command:`git ls-tree -r -z --name-only HEAD` equivalent"""
+        return list(self.ls_tree(self.tree(), True))
+
+    def tip_time(self):
+        """:command:`git log -n 1 --pretty=format:%at HEAD` equivalent"""
+        return self.commit()["author"].split()[-2]
+
+    def tree(self):
+        """:command:`git log -n 1 --pretty=format:%T HEAD` equivalent"""
+        return self.commit()["tree"]
+
+    def changes(self):
+        """:command:`git diff --name-status` equivalent
+
+        Files whose contents may differ from the index, for example because of
+        filters or line ending conversion, can't be handled and ``None`` is
+        returned so :command:`git` can make the decision.
+
+        :rtype: ``list``
+        :return: Changed files
+
+        """
+        filename = os.path.join(self.path, "index")
+        data = open(filename, "rb").read()
+        index_mtime = os.stat(filename).st_mtime
+        signature, version, count = struct.unpack(">4sII", data[:12])
+        if not signature == b"DIRC" or not version in (2, 3):
+            return None
+        changes = []
+        pos = 12
+        for _ in range(count):
+            entry = struct.unpack(">10I20sH", data[pos:pos + 62])
+            mtime, mode, size, digest, flags = entry[2], entry[6], entry[9], \
+                entry[10], entry[11]
+            length = 62
+            if flags & 0x4000:
+                # Skip-worktree and intent-to-add entries
+                if struct.unpack(">H", data[pos + 62:pos + 64])[0] & 0x6000:
+                    return None
+                length = 64
+            name = data[pos + length:data.index(b"\0", pos + length)]
+            pos += (length + len(name) + 8) & ~7
+            if flags & 0x3000:  # Unmerged
+                return None
+            elif flags & 0x8000 or mode >> 12 == 0o16:  # Assume valid or link
+                continue
+            try:
+                info = os.lstat(name)
+            except OSError:
+                changes.append("D\t%s" % text(name))
+                continue
+            if not mode >> 12 == info.st_mode >> 12 \
+                or (mode ^ info.st_mode) & 0o100:
+                changes.append("M\t%s" % text(name))
+                continue
+            if int(info.st_mtime) == mtime and info.st_size == size \
+                and info.st_mtime < index_mtime:
+                continue
+            if stat.S_ISLNK(info.st_mode):
+                content = os.readlink(name)
+            else:
+                content = open(name, "rb").read()
+            blob = sha1(("blob %i\0" % len(content)).encode("ascii"))
+            blob.update(content)
+            if not blob.digest() == digest:
+                return None
+        return changes
+
+
+class HgReader(object):
+    """Read :command:`hg` repository data without spawning processes
+
+    Version 1 dirstate files and changelogs are supported.  Anything else
+    raises an exception, and callers should fall back to the :command:`hg`
+    command.
+
+    >>> import tempfile
+    >>> path = tempfile.mkdtemp()
+    >>> entries = [b"\\0" * 40]
+    >>> for state, name in [(b"n", b"gone"), (b"a", b"added"),
+    ...                     (b"r", b"removed")]:
+    ...     entries.append(struct.pack(">cllll", state, 0o644, 0, 0,
+    ...                                len(name)) + name)
+    >>> dirstate = open(os.path.join(path, "dirstate"), "wb")
+    >>> _ = dirstate.write(b"".join(entries))
+    >>> dirstate.close()
+    >>> reader = HgReader(path)
+    >>> reader.locate()
+    ['added', 'gone']
+    >>> reader.changes()
+    ['! gone', 'A added', 'R removed']
+    >>> shutil.rmtree(path)
+
+    """
+    #: Queries answered by `HgReader`, keyed by :func:`iter_scm` or
+    #: :func:`call_scm` arguments
+    queries = {
+        ("locate -0", "\0"): "locate",
+        ("tip --template '{date}'", None): "tip_date",
+        ("tip --template '{node|short}'", None): "tip_node",
+        ("tip --template {node}", None): "tip_id",
+        ("status -mard", "\n"): "changes",
+    }
+
+    def __init__(self, path=".hg"):
+        """Initialise a new `HgReader` object
+
+        :type path: ``str``
+        :param path: Location of repository data
+
+        """
+        self.path = path
+
+    def dirstate(self):
+        """Read dirstate entries
+
+        :rtype: ``list``
+        :return: State, mode, size, modification time and name for each entry
+
+        """
+        data = open(os.path.join(self.path, "dirstate"), "rb").read()
+        if data.startswith(b"dirstate-v2"):
+            raise ValueError("Unsupported dirstate format")
+        entries = []
+        pos = 40
+        while pos < len(data):
+            state, mode, size, mtime, length = \
+                struct.unpack(">cllll", data[pos:pos + 17])
+            pos += 17
+            # Copy source follows a NUL in name
+            name = data[pos:pos + length].split(b"\0")[0]
+            entries.append((state, mode, size, mtime, name))
+            pos += length
+        return entries
+
+    def tip(self):
+        """Read the tip revision of the changelog
+
+        An inline changelog, with a delta for the tip against its parent:
+
+        >>> import tempfile
+        >>> path = tempfile.mkdtemp()
+        >>> os.makedirs(os.path.join(path, "store"))
+        >>> first = b"\\n".join([b"0" * 40, b"A <a@example.com>",
+        ...                      b"1300000000 0", b"NEWS", b"", b"Initial"])
+        >>> delta = struct.pack(">lll", 59, 71, 16) + b"1300003600 -3600"
+        >>> revlog = open(os.path.join(path, "store", "00changelog.i"), "wb")
+        >>> for version, raw, base, node in [
+        ...     (0x10001, b"u" + first, 0, b"\\1" * 20),
+        ...     (0, delta, 0, b"\\2" * 20),
+        ... ]:
+        ...     _ = revlog.write(struct.pack(">Qiiiiii20s12x", version << 32,
+        ...                                  len(raw), 0, base, 0, -1, -1,
+        ...                                  node))
+        ...     _ = revlog.write(raw)
+        >>> revlog.close()
+        >>> reader = HgReader(path)
+        >>> reader.tip_date()
+        "'1300003600.0-3600'"
+        >>> reader.tip_id() == "02" * 20
+        True
+        >>> shutil.rmtree(path)
+
+        :rtype: ``tuple``
+        :return: Binary node and text of tip revision
+
+        """
+        store = os.path.join(self.path, "store", "00changelog")
+        index = open(store + ".i", "rb").read()
+        version = struct.unpack(">I", index[:4])[0]
+        if not version & 0xffff == 1:
+            raise ValueError("Unsupported revlog version")
+        inline = version & (1 << 16)
+        general_delta = version & (1 << 17)
+        entries = []
+        pos = 0
+        while pos < len(index):
+            entry = struct.unpack(">Qiiiiii20s12x", index[pos:pos + 64])
+            entries.append((pos + 64, ) + entry)
+            pos += 64 + (inline and entry[1] or 0)
+        if not inline:
+            data = open(store + ".d", "rb").read()
+
+        def chunk(rev):
+            """Read decompressed revision data"""
+            if inline:
+                start = entries[rev][0]
+                raw = index[start:start + entries[rev][2]]
+            else:
+                start = rev and entries[rev][1] >> 16 or 0
+                raw = data[start:start + entries[rev][2]]
+            if not raw or raw[:1] == b"\0":
+                return raw
+            elif raw[:1] == b"u":
+                return raw[1:]
+            elif raw[:1] == b"x":
+                return zlib.decompress(raw)
+            raise ValueError("Unsupported revlog compression")
+
+        tip = len(entries) - 1
+        chain = [tip]
+        while not entries[chain[-1]][4] == chain[-1]:
+            if general_delta:
+                chain.append(entries[chain[-1]][4])
+            else:
+                chain.append(chain[-1] - 1)
+        revision = chunk(chain.pop())
+        while chain:
+            revision = apply_hg_delta(revision, chunk(chain.pop()))
+        return entries[tip][8], revision
+
+    def locate(self):
+        """:command:`hg locate -0` equivalent"""
+        return sorted([text(name) for state, _, _, _, name in self.dirstate()
+                       if not state == b"r"])
+
+    def tip_date(self):
+        """:command:`hg tip --template '{date}'` equivalent"""
+        timestamp, offset = self.tip()[1].split(b"\n")[2].split()[:2]
+        return "'%s.0%s'" % (text(timestamp), text(offset))
+
+    def tip_node(self):
+        """:command:`hg tip --template '{node|short}'` equivalent"""
+        return "'%s'" % self.tip_id()[:12]
+
+    def tip_id(self):
+        """:command:`hg tip --template {node}` equivalent"""
+        return text(hexlify(self.tip()[0]))
+
+    def changes(self):
+        """:command:`hg status -mard` equivalent
+
+        Files whose contents may have changed can't be handled without reading
+        the manifest, and ``None`` is returned so :command:`hg` can make the
+        decision.
+
+        :rtype: ``list``
+        :return: Changed files
+
+        """
+        changes = []
+        for state, mode, size, mtime, name in self.dirstate():
+            if state == b"a":
+                changes.append("A %s" % text(name))
+            elif state == b"r":
+                changes.append("R %s" % text(name))
+            elif state == b"n":
+                try:
+                    info = os.lstat(name)
+                except OSError:
+                    changes.append("! %s" % text(name))
+                    continue
+                if size < 0 or not info.st_size == size \
+                    or not int(info.st_mtime) == mtime \
+                    or (mode ^ info.st_mode) & 0o100:
+                    return None
+            else:  # Merge in progress
+                return None
+        return changes
+
+
+#: Native readers for each SCM, see :func:`native_scm`
+_SCM_READERS = {}
+
+
+def native_scm(options, separator=None):
+    """Answer SCM query without spawning a process
+
+    :type options: ``str``
+    :param options: SCM command options
+    :type separator: ``str``
+    :param separator: Record separator for :func:`iter_scm` queries, ``None``
+        for :func:`call_scm` queries
+    :return: Query result, or ``None`` if the SCM command must be used
+
+    """
+    _SCM_LOCK.acquire()
+    try:
+        if not _SCM_READERS:
+            if __pkg_data__.SCM == "git" and os.path.isdir(".git"):
+                _SCM_READERS["reader"] = GitReader()
+            elif __pkg_data__.SCM == "hg" and os.path.isdir(".hg"):
+                _SCM_READERS["reader"] = HgReader()
+            else:
+                _SCM_READERS["reader"] = None
+        reader = _SCM_READERS["reader"]
+        if reader is None or not (options, separator) in reader.queries:
+            return None
+        try:
+            return getattr(reader, reader.queries[(options, separator)])()
+        except Exception:  # Unsupported repository data, use SCM command
+            return None
+    finally:
+        _SCM_LOCK.release()
+#}
+
+
+#{ Documentation utilities
+def pygments_directive(name, arguments, options, content, lineno,
+                       content_offset, block_text, state, state_machine):
+    """Code colourising directive for :mod:`docutils`"""
+    if sys.version_info[:2] >= (3, 0):
+        code = '\n'.join(content)
+    else:
+        code = unicode('\n'.join(content))
+    parsed = cached_highlight(code, arguments[0], HtmlFormatter())
+    # Keep the code for read_doctree() users, such as doctest extraction
+    node = nodes.raw('', parsed, format='html', code=code)
+    node.line = content_offset + 1
+    return [node]
+pygments_directive.arguments = (1, 0, 1)
+pygments_directive.content = 1
+
+
+def cached_highlight(code, lexer_name, formatter):
+    """Highlight code, reusing output from previous builds
+
+    Output is cached in :data:`HIGHLIGHT_CACHE`, keyed by the code, lexer,
+    formatter options and Pygments version.
+
+    :type code: ``unicode``
+    :param code: Code to highlight
+    :type lexer_name: ``str``
+    :param lexer_name: Name of Pygments lexer
+    :type formatter: ``pygments.formatter.Formatter``
+    :param formatter: Pygments formatter
+    :rtype: ``unicode``
+    :return: Highlighted code
+
+    """
+    key = sha1(("%s\0%s\0%r\0" % (pygments_version, lexer_name,
+                                    sorted(formatter.options.items())))
+               .encode("utf-8"))
+    key.update(code.encode("utf-8"))
+    filename = os.path.join(HIGHLIGHT_CACHE, key.hexdigest())
+    try:
+        parsed = open(filename, "rb").read().decode("utf-8")
+    except IOError:
+        pass
+    else:
+        # Mark as recently used, for prune_highlight_cache()
+        os.utime(filename, None)
+        return parsed
+    # Previously we tested to see if the lexer existed and set a default of
+    # text if it didn't, but this hides bugs such as a typo in the directive
+    parsed = highlight(code, get_lexer_by_name(lexer_name), formatter)
+    if not os.path.isdir(HIGHLIGHT_CACHE):
+        try:
+            os.makedirs(HIGHLIGHT_CACHE)
+        except OSError:  # Created by another worker
+            pass
+    # Write under a temporary name, as other workers may be reading
+    temp = "%s.%i" % (filename, os.getpid())
+    open(temp, "wb").write(parsed.encode("utf-8"))
+    os.rename(temp, filename)
+    return parsed
+
+
+def prune_highlight_cache(limit=HIGHLIGHT_CACHE_SIZE):
+    """Remove least recently used entries from highlighting cache
+
+    :type limit: ``int``
+    :param limit: Maximum size of cache in bytes
+
+    """
+    if not os.path.isdir(HIGHLIGHT_CACHE):
+        return
+    entries = []
+    for filename in os.listdir(HIGHLIGHT_CACHE):
+        info = os.stat(os.path.join(HIGHLIGHT_CACHE, filename))
+        entries.append((info.st_mtime, info.st_size, filename))
+    size = sum([entry[1] for entry in entries])
+    for _, entry_size, filename in sorted(entries):
+        if size <= limit:
+            break
+        os.unlink(os.path.join(HIGHLIGHT_CACHE, filename))
+        size -= entry_size
+
+
+def register_code_block():
+    """Register ``code-block`` directive with :mod:`docutils`
+
+    This is also used to initialise :mod:`multiprocessing` workers, so the
+    directive is available when rendering in parallel.
+
+    """
+    directives.register_directive('code-block', pygments_directive)
+
+
+def findall(node, condition):
+    """Iterate over matching nodes in a document tree
+
+    :type node: ``docutils.nodes.Node``
+    :param node: Node to search from
+    :type condition: ``type``
+    :param condition: Node class to find
+    :rtype: ``iterable``
+    :return: Matching nodes
+
+    """
+    if hasattr(node, "findall"):
+        return node.findall(condition)
+    else:  # docutils < 0.18
+        return node.traverse(condition)
+
+
+def read_doctree(source, quiet=False):
+    """Parse reStructuredText file, reusing previous parses
+
+    Parsed documents are cached in :data:`DOCTREE_CACHE`, keyed by the
+    :func:`doc_inputs` for ``source``, so each writer and the
+    :mod:`doctest` extraction can share a single parse.
+
+    :type source: ``str``
+    :param source: reStructuredText file to parse
+    :type quiet: ``bool``
+    :param quiet: Don't display parsing errors
+    :rtype: ``docutils.nodes.document``
+    :return: Parsed document
+    :raise SystemExit: Parsing failed
+
+    """
+    settings = {"_source": source, "_destination": doc_outputs(source)[0][0]}
+    settings.update(PARSER_SETTINGS)
+    key = sha1(repr((sorted(doc_inputs(source).items()),
+                     sorted(settings.items()))).encode("utf-8"))
+    filename = os.path.join(DOCTREE_CACHE,
+                            source.replace(os.sep, "_") + ".pickle")
+    try:
+        stored_key, doctree = pickle.load(open(filename, "rb"))
+    except Exception:  # Missing or unreadable cache entry
+        pass
+    else:
+        if stored_key == key.hexdigest():
+            return doctree
+    register_code_block()
+    start = time.time()
+    stderr = sys.stderr
+    if quiet:
+        # Errors are reported on sys.stderr, even below the report level
+        sys.stderr = StringIO()
+    try:
+        doctree = publish_doctree(None, source_path=source,
+                                  source_class=FileInput,
+                                  settings_overrides=settings)
+    finally:
+        sys.stderr = stderr
+    trace_span("publish_doctree %s" % source, "doc", start)
+    # Drop unpicklable state, publish_from_doctree() recreates it
+    doctree.reporter = None
+    doctree.transformer = None
+    doctree.settings.warning_stream = None
+    if not os.path.isdir(DOCTREE_CACHE):
+        try:
+            os.makedirs(DOCTREE_CACHE)
+        except OSError:  # Created by another worker
+            pass
+    temp = "%s.%i" % (filename, os.getpid())
+    pickle.dump((key.hexdigest(), doctree), open(temp, "wb"), 2)
+    os.rename(temp, filename)
+    return doctree
+
+
+@traced("doc", 0)
+def render_doc(source, dest, writer_name="html"):
+    """Render reStructuredText file
+
+    :type source: ``str``
+    :param source: reStructuredText file to render
+    :type dest: ``str``
+    :param dest: File to write
+    :type writer_name: ``str``
+    :param writer_name: :mod:`docutils` writer to use
+    :rtype: ``bool``
+    :return: True if rendering succeeded
+
+    """
+    try:
+        doctree = read_doctree(source)
+        if not writer_name == "html":
+            # Only the HTML writer supports the parsed document's footer
+            for node in list(findall(doctree, nodes.decoration)):
+                node.parent.remove(node)
+        settings = {"_source": source}
+        settings.update(WRITER_SETTINGS[writer_name])
+        start = time.time()
+        output = publish_from_doctree(doctree, destination_path=dest,
+                                      writer_name=writer_name,
+                                      settings_overrides=settings)
+        trace_span("publish_from_doctree %s" % dest, "doc", start)
+    except SystemExit:  # docutils exits on errors
+        return False
+    open(dest, "wb").write(output)
+    return True
+
+
+def doctree_doctest(source, extraglobs):
+    """Extract :mod:`doctest` examples from a reStructuredText file
+
+    Examples are taken from doctest blocks, literal blocks and ``code-block``
+    directives in the :func:`read_doctree` output.  Parsing errors aren't
+    displayed, as callers fall back to a plain text search.
+
+    :type source: ``str``
+    :param source: reStructuredText file to read
+    :type extraglobs: ``dict``
+    :param extraglobs: Extra globals for test execution
+    :rtype: ``doctest.DocTest``
+    :return: Examples from ``source``
+    :raise SystemExit: Parsing failed
+
+    """
+    import doctest
+    parser = doctest.DocTestParser()
+    examples = []
+    lines = open(source, "rb").read().decode("utf-8", "replace").splitlines()
+    for node in findall(read_doctree(source, quiet=True), nodes.Element):
+        if isinstance(node, (nodes.doctest_block, nodes.literal_block)):
+            code = node.astext()
+        elif isinstance(node, nodes.raw) and "code" in node:
+            code = node["code"]
+        else:
+            continue
+        block = code.splitlines() or [""]
+        start = node.line or 1
+        # Older docutils set a doctest block's line to its last line
+        if not lines[start - 1:start] \
+            or not lines[start - 1].strip() == block[0].strip():
+            start = max(start - len(block) + 1, 1)
+        for example in parser.get_examples(code, source):
+            example.lineno += start - 1
+            examples.append(example)
+    globs = {"__name__": "__main__"}
+    globs.update(extraglobs)
+    return doctest.DocTest(examples, globs, os.path.basename(source), source,
+                           0, None)
+
+
+def doc_includes(source):
+    """Find files included by a reStructuredText file
+
+    :type source: ``str``
+    :param source: reStructuredText file to search
+    :rtype: ``list``
+    :return: Included files, including those included by them
+
+    """
+    includes = []
+    pending = [source]
+    while pending:
+        filename = pending.pop()
+        if not os.path.isfile(filename):
+            continue
+        for line in open(filename):
+            match = re.match(r"\s*\.\.\s+include::\s*([^<\s]\S*)", line)
+            if match:
+                include = os.path.normpath(os.path.join(
+                    os.path.dirname(filename), match.group(1)))
+                if not include in includes:
+                    includes.append(include)
+                    pending.append(include)
+    return includes
+
+
+def doc_inputs(source):
+    """Identify inputs affecting a rendered page
+
+    :type source: ``str``
+    :param source: reStructuredText file to render
+    :rtype: ``dict``
+    :return: Digests of input files, and versions of the rendering tools
+
+    """
+    import inspect
+    inputs = {
+        "docutils": docutils_version,
+        "pygments": pygments_version,
+        "highlighting": sha1(inspect.getsource(pygments_directive)
+                             .encode("utf-8")).hexdigest(),
+    }
+    for filename in [source, "doc/docutils.css"] + doc_includes(source):
+        try:
+            inputs[filename] = sha1(open(filename, "rb").read()).hexdigest()
+        except IOError:
+            inputs[filename] = None
+    return inputs
+
+
+def doc_outputs(source):
+    """Find the files rendered from a reStructuredText file
+
+    :type source: ``str``
+    :param source: reStructuredText file
+    :rtype: ``list`` of ``tuple``
+    :return: Output filename and :mod:`docutils` writer name pairs
+
+    """
+    outputs = [(os.path.splitext(source)[0] + '.html', 'html')]
+    if re.search(r"\.[1-8]\.rst$", source):
+        outputs.append((source[:-4], 'manpage'))
+    return outputs
+
+
+def read_doc_deps():
+    """Read inputs used to render pages
+
+    :rtype: ``dict``
+    :return: :func:`doc_inputs` output, keyed by page
+
+    """
+    try:
+        return pickle.load(open(DOC_DEPS, "rb"))
+    except Exception:  # Missing or unreadable database
+        return {}
+
+
+def write_doc_deps(deps):
+    """Write inputs used to render pages
+
+    :type deps: ``dict``
+    :param deps: :func:`doc_inputs` output, keyed by page
+
+    """
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    pickle.dump(deps, open(DOC_DEPS, "wb"), 2)
+
+
+def _render_worker(args):
+    """Run :func:`render_doc` in a worker process, capturing its output
+
+    :type args: ``tuple``
+    :param args: Source and destination files, and writer name
+    :rtype: ``tuple``
+    :return: Source and destination files, success and captured output
+
+    """
+    source, dest, writer_name = args
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = StringIO()
+    try:
+        success = render_doc(source, dest, writer_name)
+        return source, dest, success, sys.stdout.getvalue()
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+class StreamProxy(object):
+    """File-like object writing to whichever stream :mod:`sys` currently uses
+
+    This allows long-lived objects, such as a cached Sphinx application, to
+    follow output redirection made after they were created.
+
+    """
+
+    def __init__(self, name):
+        """Initialise a new ``StreamProxy`` object
+
+        :type name: ``str``
+        :param name: Name of :mod:`sys` stream attribute to write to
+
+        """
+        self.name = name
+
+    def write(self, data):
+        """Write data to current stream
+
+        :type data: ``str``
+        :param data: Data to write
+
+        """
+        getattr(sys, self.name).write(data)
+
+    def flush(self):
+        """Flush current stream"""
+        getattr(sys, self.name).flush()
+
+
+#: Cached Sphinx applications, see :func:`build_sphinx`
+_SPHINX_APPS = {}
+
+
+@traced("doc", 0)
+def build_sphinx(srcdir, outdir, doctreedir, jobs=1, force=False, keep=False):
+    """Build HTML documentation with Sphinx
+
+    Sphinx is run in-process when it is importable, so the package imported by
+    the configuration file is reused and only documents changed since the
+    environment in ``doctreedir`` was pickled are re-read.  ``sphinx-build`` is
+    used otherwise.
+
+    :type srcdir: ``str``
+    :param srcdir: Directory containing documentation sources
+    :type outdir: ``str``
+    :param outdir: Directory to write HTML output to
+    :type doctreedir: ``str``
+    :param doctreedir: Directory storing the Sphinx environment
+    :type jobs: ``int``
+    :param jobs: Number of parallel reading and writing processes
+    :type force: ``bool``
+    :param force: Discard the stored environment and write all files
+    :type keep: ``bool``
+    :param keep: Keep the application, and its environment, in memory for
+        later calls
+    :raise DistutilsFileError: Build failed
+
+    """
+    if not SPHINX:
+        from subprocess import check_call
+        args = ["sphinx-build", "-b", "html", "-d", doctreedir]
+        if jobs > 1:
+            args.extend(["-j", str(jobs)])
+        if force:
+            args.extend(["-E", "-a"])
+        start = time.time()
+        try:
+            check_call(args + [srcdir, outdir])
+        finally:
+            record_process(args[:1], start)
+        return
+    key = (srcdir, outdir, doctreedir, jobs)
+    app, conf_time = _SPHINX_APPS.pop(key, (None, None))
+    try:
+        current = os.path.getmtime(os.path.join(srcdir, "conf.py"))
+    except OSError:
+        current = None
+    if force or app is None or not conf_time == current:
+        app = Sphinx(srcdir, srcdir, outdir, doctreedir, "html",
+                     status=StreamProxy("stdout"),
+                     warning=StreamProxy("stderr"), freshenv=force,
+                     parallel=jobs)
+    app.build(force)
+    if keep:
+        _SPHINX_APPS[key] = (app, current)
+    if app.statuscode:
+        raise DistutilsFileError("Sphinx build failed with status %d"
+                                 % app.statuscode)
+
+
+def code_state():
+    """Modification times of the code a documentation build runs
+
+    :rtype: ``list``
+    :return: Modification time of :file:`setup.py`, :mod:`__pkg_data__` and
+        the package's modules
+
+    """
+    files = ["setup.py", __pkg_data__.__file__] \
+        + glob("%s/*.py" % __pkg_data__.MODULE.__name__)
+    state = []
+    for filename in sorted(files):
+        try:
+            state.append((filename, os.path.getmtime(filename)))
+        except OSError:
+            state.append((filename, None))
+    return state
+
+
+def read_socket(conn):
+    """Read data from a socket until the peer shuts down writing
+
+    :type conn: ``socket.socket``
+    :param conn: Connected socket
+    :rtype: ``bytes``
+    :return: Data read from ``conn``
+
+    """
+    chunks = []
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b"".join(chunks)
+#}
+
+
+class BuildDoc(NoOptsCommand):
+    """Build project documentation
+
+    .. attribute:: force
+
+       Force documentation generation
+
+    .. attribute:: jobs
+
+       Number of parallel rendering and Sphinx processes
+
+    .. attribute:: serve
+
+       Run a daemon to handle later builds
+
+    """
+    description = gen_desc(__doc__)
+    #: `BuildDoc`'s option mapping
+    user_options = [
+        ('force', 'f',
+         "force documentation generation"),
+        ('jobs=', 'j',
+         "number of parallel rendering and Sphinx processes, "
+         "0 for one per CPU"),
+        ('serve', None,
+         "run a daemon on %s to handle later builds" % DOC_SERVER),
+    ]
+    #: `BuildDoc` class' boolean options
+    boolean_options = ['force', 'serve']
+
+    def initialize_options(self):
+        """Set default values for options"""
+        self.force = False
+        self.jobs = 1
+        self.serve = False
+
+    def finalize_options(self):
+        """Finalize, and test validity, of options"""
+        self.jobs = parse_jobs(self.jobs)
+
+    def run(self):
+        """Build the required documentation"""
+        if not DOCUTILS:
+            raise DistutilsModuleError("docutils import failed, "
+                                       "can't generate documentation")
+        if not PYGMENTS:
+            # This could be a warning with conditional support for users, but
+            # how would coloured output be guaranteed in releases?
+            raise DistutilsModuleError("pygments import failed, "
+                                       "can't generate documentation")
+
+        if self.serve:
+            self.run_server()
+        elif self.dry_run or not self.call_server():
+            self.build()
+
+    def run_server(self):
+        """Handle build requests on :data:`DOC_SERVER` until interrupted
+
+        Imported modules, registered directives and the Sphinx environment
+        are kept in memory between requests.  The daemon exits when the code
+        it is running changes, leaving the request to be built by the client.
+
+        Requests and replies are JSON, and the socket is only accessible to
+        the current user.
+
+        """
+        import json
+        import socket
+        if not hasattr(socket, "AF_UNIX"):
+            raise DistutilsModuleError("Unix sockets unavailable, "
+                                       "can't run documentation daemon")
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        if os.path.exists(DOC_SERVER):
+            os.unlink(DOC_SERVER)
+        register_code_block()
+        state = code_state()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            server.bind(DOC_SERVER)
+        finally:
+            os.umask(umask)
+        server.listen(5)
+        print("Serving documentation builds on %s" % DOC_SERVER)
+        try:
+            try:
+                while True:
+                    conn = server.accept()[0]
+                    try:
+                        try:
+                            request = json.loads(
+                                read_socket(conn).decode("utf-8"))
+                            request = {"force": bool(request["force"]),
+                                       "jobs": int(request["jobs"])}
+                        except (KeyError, TypeError, ValueError):
+                            print("Ignoring malformed request")
+                            continue
+                        if not code_state() == state:
+                            print("Build code changed, exiting")
+                            break
+                        print("Building documentation")
+                        reply = json.dumps(self.handle_request(request))
+                        conn.sendall(reply.encode("utf-8"))
+                    finally:
+                        conn.close()
+            except KeyboardInterrupt:
+                pass
+        finally:
+            server.close()
+            os.unlink(DOC_SERVER)
+
+    def handle_request(self, request):
+        """Build documentation for a :meth:`call_server` request
+
+        :type request: ``dict``
+        :param request: Client's option values
+        :rtype: ``list``
+        :return: Build output, and error message or ``None``
+
+        """
+        self.force = request["force"]
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = StringIO()
+        error = None
+        try:
+            try:
+                self.jobs = parse_jobs(request["jobs"])
+                self.build()
+            except (Exception, SystemExit):
+                error = str(sys.exc_info()[1])
+            return [sys.stdout.getvalue(), error]
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    def call_server(self):
+        """Pass build request to a :meth:`run_server` daemon
+
+        :rtype: ``bool``
+        :return: True if a daemon handled the request
+
+        """
+        if not os.path.exists(DOC_SERVER):
+            return False
+        import json
+        import socket
+        if not hasattr(socket, "AF_UNIX"):
+            return False
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                client.connect(DOC_SERVER)
+                request = json.dumps({"force": self.force, "jobs": self.jobs})
+                client.sendall(request.encode("utf-8"))
+                client.shutdown(socket.SHUT_WR)
+                reply = read_socket(client)
+            except socket.error:  # Stale socket file
+                return False
+        finally:
+            client.close()
+        if not reply:  # Daemon exited without handling request
+            return False
+        output, error = json.loads(reply.decode("utf-8"))
+        sys.stdout.write(output)
+        if error:
+            raise DistutilsFileError(error)
+        return True
+
+    def build(self):
+        """Build the required documentation in this process"""
+        register_code_block()
+        deps = read_doc_deps()
+        inputs = {}
+        pending = []
+        for source in sorted(["NEWS.rst", "README.rst"] + glob('doc/*.rst')):
+            source_inputs = doc_inputs(source)
+            for dest, writer_name in doc_outputs(source):
+                inputs[dest] = source_inputs
+                if self.force or not os.path.isfile(dest) \
+                    or not deps.get(dest) == inputs[dest]:
+                    if self.dry_run:
+                        print('Building file %s' % dest)
+                        continue
+                    pending.append((source, dest, writer_name))
+                    # Forget inputs until page has been successfully rendered
+                    deps.pop(dest, None)
+        failed = []
+        if self.jobs > 1 and len(pending) > 1:
+            pool = multiprocessing.Pool(min(self.jobs, len(pending)),
+                                        register_code_block)
+            try:
+                for source, dest, success, output in \
+                    pool.imap_unordered(_render_worker, pending):
+                    print('Building file %s' % dest)
+                    sys.stdout.write(output)
+                    if success:
+                        deps[dest] = inputs[dest]
+                    else:
+                        failed.append(source)
+            finally:
+                pool.terminate()
+                pool.join()
+                write_doc_deps(deps)
+        else:
+            try:
+                for source, dest, writer_name in pending:
+                    print('Building file %s' % dest)
+                    if render_doc(source, dest, writer_name):
+                        deps[dest] = inputs[dest]
+                    else:
+                        failed.append(source)
+            finally:
+                write_doc_deps(deps)
+        if not self.dry_run:
+            prune_highlight_cache()
+        if failed:
+            raise DistutilsFileError("Documentation build failed for %s"
+                                     % ", ".join(sorted(set(failed))))
+        print("Building sphinx tree")
+        if not os.path.isdir("doc/html"):
+            os.mkdir("doc/html")
+        build_sphinx("doc/source", "doc/html", "doc/source/.doctrees",
+                     self.jobs, self.force, self.serve)
+
+        files = glob("%s/*.py" % __pkg_data__.MODULE.__name__)
+        files.extend(["%s.py" % i.__name__ for i in __pkg_data__.SCRIPTS])
+        if self.force or not os.path.isfile("ChangeLog"):
+            execute(write_changelog, ("ChangeLog", ))
+        else:
+            cl_time = os.stat("ChangeLog").st_mtime
+            if __pkg_data__.SCM == "hg" and os.path.isdir(".hg"):
+                output = call_scm("tip --template '{date}'", cache=True)
+                tip_time = float(output[1:output.find("-")])
+            elif __pkg_data__.SCM == "git" and os.path.isdir(".git"):
+                output = call_scm("log -n 1 --pretty=format:%at HEAD",
+                                  cache=True)
+                tip_time = int(output)
+            else:
+                print("Unable to build ChangeLog, dir is not a %s clone"
+                      % __pkg_data__.SCM)
+                return False
+            if tip_time > cl_time:
+                execute(write_changelog, ("ChangeLog", ))
+
+        if hasattr(__pkg_data__, "BuildDoc_run"):
+            __pkg_data__.BuildDoc_run(self.dry_run, self.force)
+
+
+#{ Distribution utilities
+def scm_finder(*none):
+    """Find files for distribution tarball
+
+    This is only used when ``setuptools`` is imported, simply to create a valid
+    list of files to distribute.  Standard setuptools only works with CVS.
+    Without this it *appears* to work, but only distributes a very small subset
+    of the package.
+
+    .. seealso::
+
+       :class:`MySdist.get_file_list`
+
+    :type none: any
+    :param none: Just for compatibility
+    """
+    return distribution_files(scm_files())
+    if __pkg_data__.SCM == "hg":
+        finders.append((convert_path('.hg/dirstate'), scm_finder))
+    elif __pkg_data__.SCM == "git":
+        finders.append((convert_path('.git/index'), scm_finder))
+
+
+def scm_files():
+    """List files tracked by SCM
+
+    :rtype: ``list``
+    :return: Tracked files
+
+    """
+    # setuptools documentation says this shouldn't be a hard fail, but we won't
+    # do that as it makes builds entirely unpredictable
+    if __pkg_data__.SCM == "hg":
+        options = "locate -0"
+    elif __pkg_data__.SCM == "git":
+        options = "ls-tree -r -z --full-name --name-only HEAD"
+    return list(iter_scm(options, "\0", cache=True))
+
+
+def scm_changed():
+    """Check for uncommitted changes
+
+    :rtype: ``bool``
+    :return: True if the working tree has uncommitted changes
+    :raise ValueError: Unknown SCM type
+
+    """
+    if __pkg_data__.SCM == "hg":
+        changes = iter_scm("status -mard")
+    elif __pkg_data__.SCM == "git":
+        changes = iter_scm("diff --name-status")
+    else:
+        raise ValueError("Unknown SCM type %r" % (__pkg_data__.SCM, ))
+    # Only the first change is needed, the command is killed after it
+    return any(changes)
+
+
+def scm_revision():
+    """Fetch the current SCM changeset identifier
+
+    :rtype: ``str``
+    :return: Changeset identifier
+    :raise ValueError: Unknown SCM type
+
+    """
+    if __pkg_data__.SCM == "hg":
+        # This could use `hg identify' but that outputs other unused
+        # information
+        return call_scm("tip --template '{node|short}'", cache=True)[1:-1]
+    elif __pkg_data__.SCM == "git":
+        return call_scm("log -n 1 --pretty=format:%T HEAD", cache=True)
+    else:
+        raise ValueError("Unknown SCM type %r" % (__pkg_data__.SCM, ))
+
+
+def artifact_key(revision, *config):
+    """Generate an artifact store key for a tree
+
+    >>> len(artifact_key("4b825dc6", "gztar"))
+    40
+    >>> artifact_key("4b825dc6", "gztar") == artifact_key("4b825dc6", "bztar")
+    False
+
+    :type revision: ``str``
+    :param revision: Tree identifier, from :func:`scm_revision`
+    :type config: ``tuple``
+    :param config: Build configuration affecting the artifacts
+    :rtype: ``str``
+    :return: Key for :func:`fetch_artifacts` and :func:`store_artifacts`
+
+    """
+    return sha1(repr((revision, config)).encode("utf-8")).hexdigest()
+
+
+@traced("archive")
+def fetch_artifacts(key, directory, cache_dir=ARTIFACT_CACHE):
+    """Copy stored artifacts to a directory
+
+    >>> import tempfile
+    >>> cache_dir = tempfile.mkdtemp()
+    >>> fetch_artifacts(artifact_key("4b825dc6"), "dist", cache_dir) is None
+    True
+    >>> shutil.rmtree(cache_dir)
+
+    :type key: ``str``
+    :param key: Key from :func:`artifact_key`
+    :type directory: ``str``
+    :param directory: Directory to copy artifacts to
+    :type cache_dir: ``str``
+    :param cache_dir: Artifact store location
+    :rtype: ``list``
+    :return: Copied files, or ``None`` if no artifacts are stored for ``key``
+
+    """
+    entry = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry):
+        return None
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    files = []
+    for filename in sorted(os.listdir(entry)):
+        files.append(os.path.join(directory, filename))
+        shutil.copy2(os.path.join(entry, filename), files[-1])
+    # Mark as recently used for prune_artifacts()
+    os.utime(entry, None)
+    return files
+
+
+@traced("archive")
+def store_artifacts(key, files, cache_dir=ARTIFACT_CACHE,
+                    limit=ARTIFACT_CACHE_SIZE):
+    """Store artifacts for later builds of the same tree
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> cache_dir = os.path.join(directory, "artifacts")
+    >>> dist = os.path.join(directory, "dist")
+    >>> artifact = os.path.join(directory, "project-0.1.tar.gz")
+    >>> write_file(artifact, ["data"])
+    >>> key = artifact_key("4b825dc6", "gztar")
+    >>> store_artifacts(key, [artifact], cache_dir)
+    >>> fetch_artifacts(key, dist, cache_dir) \\
+    ...     == [os.path.join(dist, "project-0.1.tar.gz")]
+    True
+
+    Least recently used entries are evicted when the store is over its size
+    limit:
+
+    >>> os.utime(os.path.join(cache_dir, key), (0, 0))
+    >>> store_artifacts(artifact_key("8f2a1c3e", "gztar"), [artifact],
+    ...                 cache_dir, limit=1)
+    >>> fetch_artifacts(key, dist, cache_dir) is None
+    True
+    >>> shutil.rmtree(directory)
+
+    :type key: ``str``
+    :param key: Key from :func:`artifact_key`
+    :type files: ``list``
+    :param files: Artifacts to store
+    :type cache_dir: ``str``
+    :param cache_dir: Artifact store location
+    :type limit: ``int``
+    :param limit: Maximum size of store in bytes
+
+    """
+    entry = os.path.join(cache_dir, key)
+    temp = "%s.%i" % (entry, os.getpid())
+    if os.path.isdir(entry):
+        shutil.rmtree(entry)
+    os.makedirs(temp)
+    try:
+        for filename in files:
+            shutil.copy2(filename, temp)
+        os.rename(temp, entry)
+    finally:
+        if os.path.isdir(temp):
+            shutil.rmtree(temp)
+    prune_artifacts(limit, cache_dir)
+
+
+def prune_artifacts(limit=ARTIFACT_CACHE_SIZE, cache_dir=ARTIFACT_CACHE):
+    """Remove least recently used entries from artifact store
+
+    :type limit: ``int``
+    :param limit: Maximum size of store in bytes
+    :type cache_dir: ``str``
+    :param cache_dir: Artifact store location
+
+    """
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, key)
+        size = sum([os.path.getsize(os.path.join(entry, filename))
+                    for filename in os.listdir(entry)])
+        entries.append((os.stat(entry).st_mtime, size, entry))
+    size = sum([entry[1] for entry in entries])
+    # Always keep the newest entry, even if it is over the limit alone
+    for _, entry_size, entry in sorted(entries)[:-1]:
+        if size <= limit:
+            break
+        shutil.rmtree(entry)
+        size -= entry_size
+
+
+def distribution_files(files):
+    """Add generated files to list of files for distribution tarball
+
+    :type files: ``list``
+    :param files: Files tracked by SCM
+    :rtype: ``list``
+    :return: Files to distribute
+
+    """
+    distributed_files = files[:]
+    distributed_files.append(".%s_version" % __pkg_data__.SCM)
+    distributed_files.append("ChangeLog")
+    distributed_files.extend(glob("*.html"))
+    distributed_files.extend(glob("doc/*.html"))
+    for path, directory, filenames in os.walk("html"):
+        for filename in filenames:
+            distributed_files.append(os.path.join(path, filename))
+    return distributed_files
+
+
+class ScmSdist(sdist):
+    """Create a source distribution tarball
+
+    .. seealso::
+
+       :class:`sdist`
+
+    .. attribute: repo
+
+       SCM repository object
+
+    .. attribute:: changed
+
+       :class:`ScmQuery` for uncommitted changes check
+
+    .. attribute:: files
+
+       :class:`ScmQuery` for tracked files
+
+    .. attribute:: revision
+
+       :class:`ScmQuery` for changeset identifier
+
+    .. attribute:: compress_jobs
+
+       Number of compression threads
+
+    """
+    description = gen_desc(__doc__)
+    #: `ScmSdist`'s option mapping
+    user_options = [
+        ('force-build', 'b', "force build with stale version number"),
+        ('compress-jobs=', None,
+         "number of compression threads, 0 for one per CPU"),
+    ] + sdist.user_options
+    boolean_options = ['force-build']
+
+    def initialize_options(self):
+        """Set default values for options"""
+        sdist.initialize_options(self)
+        self.force_build = False
+        self.compress_jobs = 1
+        if not __pkg_data__.SCM in ("hg", "git"):
+            raise ValueError("Unknown SCM type %r" % (__pkg_data__.SCM, ))
+        # These are independent, so start them together and wait for results
+        # only when they're needed
+        self.changed = ScmQuery(scm_changed)
+        self.files = ScmQuery(scm_files)
+        self.revision = ScmQuery(scm_revision)
+
+    def finalize_options(self):
+        """Finalize, and test validity, of options"""
+        sdist.finalize_options(self)
+        self.compress_jobs = parse_jobs(self.compress_jobs)
+        if self.changed.result():
+            raise DistutilsFileError("Uncommitted changes!")
+
+    def run(self):
+        """Build distribution, unless this tree has already been built
+
+        Documentation is built, and tests are run, before building a new
+        distribution.  The version checks are made, and the version file
+        written, even if a stored distribution is used.
+
+        """
+        self.check_news()
+        execute(self.write_version, ())
+        key = artifact_key(self.revision.result(), "sdist",
+                           tuple(self.formats), self.compress_jobs > 1)
+        files = fetch_artifacts(key, self.dist_dir)
+        if files:
+            print("Using stored distribution %s" % ", ".join(files))
+            self.archive_files = files
+            for filename in files:
+                self.distribution.dist_files.append(('sdist', '', filename))
+            return
+        for command in ("build_doc", "test_doc", "test_code"):
+            if command.startswith("test_"):
+                self.distribution.get_command_obj(command).exit_on_fail = True
+            self.run_command(command)
+        sdist.run(self)
+        if not self.dry_run:
+            store_artifacts(key, self.archive_files)
+
+    def get_file_list(self):
+        """Generate MANIFEST file contents from SCM"""
+        manifest_files = distribution_files(self.files.result())
+        execute(write_manifest, [manifest_files], "writing MANIFEST")
+        sdist.get_file_list(self)
+
+    def check_news(self):
+        """Exit if :file:`NEWS.rst` has no recent entry for this version"""
+        news_format = "%s - " % __pkg_data__.MODULE.__version__
+        news_matches = [line for line in open("NEWS.rst")
+                        if line.startswith(news_format)]
+        if not any(news_matches):
+            print("NEWS.rst entry for %r missing"
+                  % (__pkg_data__.MODULE.__version__, ))
+            sys.exit(1)
+        news_time = time.mktime(time.strptime(news_matches[0].split()[-1],
+                                "%Y-%m-%d"))
+        if time.time() - news_time > 86400 and not self.force_build:
+            print("NEWS.rst entry is older than a day, version may not have "
+                  "been updated")
+            sys.exit(1)
+
+    def make_distribution(self):
+        """Build distribution"""
+        if self.owner or self.group or not MULTIPROCESSING \
+            or not set(self.formats).issubset(list(ARCHIVE_FORMATS) + ["zip"]):
+            sdist.make_distribution(self)
+            return
+        base_dir = self.distribution.get_fullname()
+        base_name = os.path.join(self.dist_dir, base_dir)
+        self.mkpath(self.dist_dir)
+        self.archive_files = []
+        for format in self.formats:
+            if format == "zip":
+                filename = "%s.zip" % base_name
+            elif ARCHIVE_FORMATS[format]:
+                filename = "%s.tar.%s" % (base_name, ARCHIVE_FORMATS[format])
+            else:
+                filename = "%s.tar" % base_name
+            self.archive_files.append(filename)
+            self.distribution.dist_files.append(('sdist', '', filename))
+        execute(self.write_archives, (base_dir, ),
+                "creating %s" % ", ".join(self.archive_files),
+                dry_run=self.dry_run)
+
+    @traced("archive")
+    def release_metadata(self):
+        """Generate files added to the release tree by :class:`sdist`
+
+        :rtype: ``dict``
+        :return: Contents of :file:`PKG-INFO` and :file:`setup.cfg`
+
+        """
+        output = StringIO()
+        self.distribution.metadata.write_pkg_file(output)
+        files = {"PKG-INFO": output.getvalue().encode("utf-8")}
+        # egg_info can only update a config file in place
+        temp = "%s.%i" % (os.path.join(CACHE_DIR, "setup.cfg"), os.getpid())
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        try:
+            if os.path.isfile("setup.cfg"):
+                shutil.copyfile("setup.cfg", temp)
+            self.get_finalized_command('egg_info').save_version_info(temp)
+            if os.path.isfile(temp):
+                files["setup.cfg"] = open(temp, "rb").read()
+        finally:
+            if os.path.exists(temp):
+                os.unlink(temp)
+        return files
+
+    @traced("archive", 1)
+    def write_archives(self, base_dir):
+        """Write all requested archives in a single pass over the files
+
+        Each file is mapped in to memory once, and handed to every archive's
+        writer concurrently.  Members are written in sorted order.
+
+        :type base_dir: ``str``
+        :param base_dir: Directory name for archive members
+
+        """
+        import mmap
+        generated = self.release_metadata()
+        members = set(generated)
+        for filename in self.filelist.files:
+            members.add(os.path.normpath(filename).replace(os.sep, "/"))
+            parent = os.path.dirname(filename)
+            while parent:
+                members.add(parent.replace(os.sep, "/") + "/")
+                parent = os.path.dirname(parent)
+        now = time.time()
+        writers = [ArchiveWriter(filename, format, self.compress_jobs)
+                   for filename, format in zip(self.archive_files,
+                                               self.formats)]
+        pool = ThreadPool(len(writers))
+        try:
+            pool.map(lambda writer: writer.add(base_dir, None, 0, now),
+                     writers)
+            for name in sorted(members):
+                arcname = "%s/%s" % (base_dir, name.rstrip("/"))
+                if name.endswith("/"):
+                    status = os.stat(name)
+                    data = None
+                elif name in generated:
+                    status = None
+                    data = generated[name]
+                else:
+                    status = os.stat(name)
+                    data = map_file(name)
+                mode = status and status.st_mode or 0o644
+                mtime = status and status.st_mtime or now
+                try:
+                    pool.map(lambda writer: writer.add(arcname, data, mode,
+                                                       mtime),
+                             writers)
+                finally:
+                    if isinstance(data, mmap.mmap):
+                        data.close()
+            for writer in writers:
+                writer.close()
+        finally:
+            pool.close()
+            pool.join()
+
+    def make_archive(self, base_name, format, root_dir=None, base_dir=None,
+                     owner=None, group=None):
+        """Create archive, compressing tarballs in parallel if requested
+
+        .. seealso::
+
+           :meth:`distutils.cmd.Command.make_archive`
+
+        """
+        compression = ARCHIVE_FORMATS.get(format)
+        if self.compress_jobs == 1 or not compression in COMPRESSORS \
+            or compression == "xz" and not LZMA or root_dir or owner or group:
+            return sdist.make_archive(self, base_name, format, root_dir,
+                                      base_dir, owner, group)
+        filename = "%s.tar.%s" % (base_name, compression)
+        self.mkpath(os.path.dirname(filename))
+        execute(self.write_archive, (filename, compression, base_dir),
+                "creating %s" % filename, dry_run=self.dry_run)
+        return filename
+
+    @traced("archive", 1)
+    def write_archive(self, filename, compression, base_dir):
+        """Write tarball of a directory tree
+
+        :type filename: ``str``
+        :param filename: Tarball to write
+        :type compression: ``str``
+        :param compression: Compression name from :data:`COMPRESSORS`
+        :type base_dir: ``str``
+        :param base_dir: Directory to archive
+
+        """
+        tarball = open_tarball(filename, compression, self.compress_jobs)
+        try:
+            tarball.add(base_dir)
+        finally:
+            tarball.close()
+
+    def write_version(self):
+        """Store the current SCM changeset identifier in a file"""
+        write_file(".%s_version" % __pkg_data__.SCM,
+                   (self.revision.result(), ))
+
+
+class Snapshot(NoOptsCommand):
+    """Build a daily snapshot tarball
+
+    .. attribute:: compress_jobs
+
+       Number of compression threads
+
+    """
+    description = gen_desc(__doc__)
+    #: `Snapshot`'s option mapping
+    user_options = [
+        ('compress-jobs=', None,
+         "number of compression threads, 0 for one per CPU"),
+    ]
+
+    def initialize_options(self):
+        """Set default values for options"""
+        self.compress_jobs = 1
+
+    def finalize_options(self):
+        """Finalize, and test validity, of options"""
+        self.compress_jobs = parse_jobs(self.compress_jobs)
+
+    def run(self):
+        """Prepare and create tarball"""
+        snapshot_name = "%s-%s" % (__pkg_data__.MODULE.__name__,
+                                   time.strftime("%Y-%m-%d"))
+        key = artifact_key(scm_revision(), "snapshot", snapshot_name,
+                           self.compress_jobs > 1)
+        files = fetch_artifacts(key, "dist")
+        if files:
+            print("Using stored snapshot %s" % files[0])
+            return
+        if not os.path.isdir("dist"):
+            execute(os.mkdir, ("dist", ))
+        execute(write_changelog, (SNAPSHOT_CHANGELOG, ))
+        filename = "dist/%s.tar.bz2" % snapshot_name
+        execute(self.write_tarball, (snapshot_name, filename,
+                                     self.compress_jobs))
+        if not self.dry_run:
+            store_artifacts(key, [filename])
+
+    @staticmethod
+    @traced("archive", 1)
+    def write_tarball(prefix, filename, compress_jobs=1):
+        """Stream a clean SCM archive in to a compressed tarball
+
+        The SCM's tar output is read as a stream, and its members are written
+        directly to the compressed tarball along with the generated
+        :file:`ChangeLog`, without extracting the tree to disk.
+
+        :type prefix: ``str``
+        :param prefix: Directory name for tarball members
+        :type filename: ``str``
+        :param filename: Tarball to write
+        :type compress_jobs: ``int``
+        :param compress_jobs: Number of compression threads
+        :raise ValueError: Unknown SCM type
+
+        """
         if __pkg_data__.SCM == "hg":
-            call_scm("archive %s" % snapshot_name)
+            options = scm_args("archive -t tar --prefix %s -" % prefix)
         elif __pkg_data__.SCM == "git":
-            basename = os.path.basename(snapshot_name)
-            call_scm("git archive --prefix=%s/ HEAD" % basename,
-                     stdout=open("%s.tar" % basename, "w"))
-            check_call(("tar xfv %s.tar -C %s" % (basename, "dist")).split())
-            os.remove("%s.tar" % basename)
+            options = scm_args("archive --prefix=%s/ HEAD" % prefix)
         else:
             raise ValueError("Unknown SCM type %r" % (__pkg_data__.SCM, ))
+        import tarfile
+        from subprocess import PIPE
+        changelog = "%s/ChangeLog" % prefix
+        start = time.time()
+        process = open_scm(options, stdout=PIPE)
+        temp = "%s.%i" % (filename, os.getpid())
+        try:
+            archive = tarfile.open(fileobj=process.stdout, mode="r|")
+            output = open_tarball(temp, "bz2", compress_jobs)
+            for member in archive:
+                if member.name == changelog:  # Replaced by generated version
+                    continue
+                if member.isfile():
+                    output.addfile(member, archive.extractfile(member))
+                else:
+                    output.addfile(member)
+            if os.path.isfile(SNAPSHOT_CHANGELOG):
+                member = output.gettarinfo(SNAPSHOT_CHANGELOG, changelog)
+                member.uid = member.gid = 0
+                member.uname = member.gname = ""
+                member.mode = 0o644
+                output.addfile(member, open(SNAPSHOT_CHANGELOG, "rb"))
+            output.close()
+            archive.close()
+            process.wait()
+            record_process(options, start)
+            check_scm(options, process.returncode)
+            os.rename(temp, filename)
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            if os.path.exists(temp):
+                os.unlink(temp)
 #}
 
 
+class BenchCompress(NoOptsCommand):
+    """Compare serial and parallel archive compression
+
+    .. attribute:: compress_jobs
+
+       Number of compression threads for the parallel runs
+
+    .. attribute:: input
+
+       File to compress
+
+    """
+    description = gen_desc(__doc__)
+    #: `BenchCompress`'s option mapping
+    user_options = [
+        ('compress-jobs=', None,
+         "number of compression threads, 0 for one per CPU [0]"),
+        ('input=', 'i',
+         "file to compress, defaults to a tarball of distribution files"),
+    ]
+
+    def initialize_options(self):
+        """Set default values for options"""
+        self.compress_jobs = 0
+        self.input = None
+
+    def finalize_options(self):
+        """Finalize, and test validity, of options"""
+        self.compress_jobs = parse_jobs(self.compress_jobs)
+
+    def run(self):
+        """Time compression of the input with each compressor"""
+        if self.input:
+            data = open(self.input, "rb").read()
+        else:
+            import tarfile
+            output = BytesIO()
+            tarball = tarfile.open(fileobj=output, mode="w|")
+            for filename in sorted(distribution_files(scm_files())):
+                tarball.add(filename, recursive=False)
+            tarball.close()
+            data = output.getvalue()
+        print("Compressing %i bytes, %i threads for parallel runs"
+              % (len(data), self.compress_jobs))
+        for compression in sorted(COMPRESSORS):
+            if compression == "xz" and not LZMA:
+                continue
+            start = time.time()
+            serial = COMPRESSORS[compression](data)
+            serial_time = time.time() - start
+            output = BytesIO()
+            start = time.time()
+            compressor = ParallelCompressor(output, compression,
+                                            self.compress_jobs)
+            compressor.write(data)
+            compressor.close()
+            parallel_time = time.time() - start
+            print("  %s: serial %.2fs %i bytes, parallel %.2fs %i bytes, "
+                  "%.1fx" % (compression, serial_time, len(serial),
+                             parallel_time, len(output.getvalue()),
+                             serial_time / max(parallel_time, 1e-6)))
+
+
 class MyClean(clean):
     """Clean built and temporary files
 
@@ -438,76 +3494,704 @@ class MyClean(clean):
         if self.all:
             for filename in [".git_version", ".hg_version", "ChangeLog",
                              "MANIFEST"] \
-                + glob("*.html") + glob("doc/*.html") \
+                + glob("*.html") + glob("doc/*.html") + glob("doc/*.[1-8]") \
                 + glob("%s/*.pyc" % __pkg_data__.MODULE.__name__):
                 if os.path.exists(filename):
                     os.unlink(filename)
             execute(shutil.rmtree, ("html", True))
             execute(shutil.rmtree, ("doc/html", True))
             execute(shutil.rmtree, ("doc/source/.doctrees", True))
+            execute(shutil.rmtree, (CACHE_DIR, True))
         if hasattr(__pkg_data__, "MyClean_run"):
             __pkg_data__.MyClean_run(self.dry_run, self.force)
 
 
 #{ Testing utilities
+def changed_lines(ref, files):
+    """Find lines changed in the working tree since a given revision
+
+    :type ref: ``str``
+    :param ref: Revision to compare against
+    :type files: ``list``
+    :param files: Files to check
+    :rtype: ``dict``
+    :return: Sets of changed line numbers keyed by filename
+
+    """
+    if __pkg_data__.SCM == "hg":
+        options = "diff -U0 -r %s %s"
+    else:
+        options = "diff -U0 %s -- %s"
+    output = call_scm(options % (ref, " ".join(files)))
+    changed = {}
+    for line in output.splitlines():
+        if line.startswith("+++ "):
+            filename = line[4:].split("\t")[0]
+            if filename.startswith("b/"):
+                filename = filename[2:]
+            lines = changed.setdefault(filename, set())
+        elif line.startswith("@@ "):
+            match = re.match(r"@@ -\S+ \+(\d+)(?:,(\d+))? @@", line)
+            start = int(match.group(1))
+            count = match.group(2)
+            # Pure deletions mark the line following the removal
+            count = count is None and 1 or max(int(count), 1)
+            lines.update(range(start, start + count))
+    return changed
+
+
+def select_doctests(module, lines, extraglobs):
+    """Find :mod:`doctest` examples affected by changes to a module
+
+    Tests are selected when their object's source overlaps ``lines``, or when
+    their source refers to the name of a selected object in the same module.
+    Tests from ``__test__`` have no source object to compare, so they are
+    always selected.
+
+    :type module: ``module``
+    :param module: Module to search for tests
+    :type lines: ``set``
+    :param lines: Changed line numbers in module's source
+    :type extraglobs: ``dict``
+    :param extraglobs: Extra globals for test execution
+    :rtype: ``list`` of ``doctest.DocTest``
+    :return: Affected tests
+
+    """
+    import doctest
+    import inspect
+    sources = {}
+    selected = []
+    for test in doctest.DocTestFinder().find(module, extraglobs=extraglobs):
+        names = test.name.split(".")[len(module.__name__.split(".")):]
+        if names[:1] == ["__test__"]:
+            selected.append(test)
+            continue
+        obj = module
+        for name in names:
+            obj = getattr(obj, name)
+        if inspect.ismodule(obj):
+            # Only the docstring itself, as a module spans the entire file
+            start = test.lineno + 1
+            source = test.docstring.splitlines(True)
+        else:
+            try:
+                source, start = inspect.getsourcelines(obj)
+            except (IOError, TypeError):
+                continue
+        span = set(range(start, start + len(source)))
+        sources[test] = (test.name.split(".")[-1], "".join(source), span)
+    selected.extend([test for test, (_, _, span) in sources.items()
+                     if span.intersection(lines)])
+    # Include callers of selected objects, until no more are found
+    pending = selected[:]
+    while pending:
+        test = pending.pop()
+        if not test in sources:  # __test__ entry
+            continue
+        name = sources[test][0]
+        for test, (_, source, _) in sources.items():
+            if not test in selected \
+                and re.search(r"\b%s\b" % re.escape(name), source):
+                selected.append(test)
+                pending.append(test)
+    return sorted(selected, key=lambda test: test.name)
+
+
+def module_name(filename):
+    """Find the name of the module imported from a Python file
+
+    :type filename: ``str``
+    :param filename: Python file
+    :rtype: ``str``
+    :return: Dotted module name
+
+    """
+    module = os.path.splitext(filename)[0].replace("/", ".")
+    if module.endswith("__init__"):
+        module = module[:-9]
+    return module
+
+
+class DocTestTimeout(BaseException):
+    """Raised when a :mod:`doctest` example or file exceeds its time limit
+
+    This isn't an :exc:`Exception` subclass, so examples catching
+    :exc:`Exception` can't swallow it.
+
+    """
+
+
+class TimedDocTestRunner(object):
+    """:class:`doctest.DocTestRunner` recording the duration of each example
+
+    :mod:`doctest` is only imported when tests are run, so this is combined
+    with :class:`doctest.DocTestRunner` by :func:`doctest_runner`.  Base
+    methods are called explicitly, as :class:`doctest.DocTestRunner` is an
+    old-style class on Python 2.
+
+    Examples are interrupted with :data:`signal.SIGALRM` when they exceed
+    ``example_timeout``, or the file's tests exceed ``file_timeout``.  The
+    interrupted example fails, and a file timeout stops the remaining tests
+    with :exc:`DocTestTimeout`.
+
+    >>> import doctest
+    >>> class Runner(TimedDocTestRunner, doctest.DocTestRunner):
+    ...     pass
+    >>> test = doctest.DocTestParser().get_doctest(">>> 1 + 1\\n2\\n", {},
+    ...                                            "example", None, 0)
+    >>> runner = Runner()
+    >>> runner.run(test)
+    TestResults(failed=0, attempted=1)
+    >>> [timing[1:] for timing in runner.timings]
+    [(None, 'example', 1)]
+
+    .. attribute:: timings
+
+       Duration, filename, test name and line for each example run
+
+    """
+
+    def __init__(self, optionflags=0, example_timeout=None, file_timeout=None):
+        """Initialise a new `TimedDocTestRunner` object
+
+        :type optionflags: ``int``
+        :param optionflags: :mod:`doctest` option flags
+        :type example_timeout: ``float``
+        :param example_timeout: Seconds an example may run for
+        :type file_timeout: ``float``
+        :param file_timeout: Seconds all examples may run for
+
+        """
+        import doctest
+        doctest.DocTestRunner.__init__(self, optionflags=optionflags)
+        self.example_timeout = example_timeout
+        self.deadline = file_timeout and time.time() + file_timeout
+        self.file_timeout = file_timeout
+        self.timings = []
+        self.started = None
+        self.limit = None
+
+    def run(self, test, *args, **kwargs):
+        """Run examples in a test, with timeouts if requested
+
+        :type test: ``doctest.DocTest``
+        :param test: Test to run
+        :rtype: ``tuple``
+        :return: Number of failed and attempted examples
+        :raise DocTestTimeout: File time limit exceeded
+
+        """
+        import doctest
+        if not self.example_timeout and not self.deadline:
+            return doctest.DocTestRunner.run(self, test, *args, **kwargs)
+        previous = signal.signal(signal.SIGALRM, self.alarm)
+        try:
+            return doctest.DocTestRunner.run(self, test, *args, **kwargs)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+    def alarm(self, signum, frame):
+        """Interrupt the running example
+
+        :raise DocTestTimeout: Always
+
+        """
+        raise DocTestTimeout(self.limit)
+
+    def report_start(self, out, test, example):
+        """Start timing an example
+
+        :raise DocTestTimeout: File time limit exceeded
+
+        """
+        import doctest
+        doctest.DocTestRunner.report_start(self, out, test, example)
+        self.started = time.time()
+        limit = self.example_timeout
+        if limit:
+            self.limit = "Example exceeded %gs time limit" % (limit, )
+        if self.deadline:
+            remaining = self.deadline - self.started
+            if remaining <= 0:
+                raise DocTestTimeout("Tests exceeded %gs time limit"
+                                     % (self.file_timeout, ))
+            if not limit or remaining < limit:
+                limit = remaining
+                self.limit = "Tests exceeded %gs time limit" \
+                    % (self.file_timeout, )
+        if limit:
+            signal.setitimer(signal.ITIMER_REAL, limit)
+
+    def stop(self, test, example):
+        """Record the duration of the running example
+
+        :type test: ``doctest.DocTest``
+        :param test: Test containing example
+        :type example: ``doctest.Example``
+        :param example: Example that completed
+
+        """
+        if self.example_timeout or self.deadline:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        # Examples aren't started when reporting is suppressed by
+        # REPORT_ONLY_FIRST_FAILURE
+        if self.started is None:
+            return
+        if test.lineno is None:
+            line = None
+        else:
+            line = test.lineno + example.lineno + 1
+        self.timings.append((time.time() - self.started, test.filename,
+                             test.name, line))
+        self.started = None
+
+    def report_success(self, out, test, example, got):
+        """Record duration of a passing example"""
+        import doctest
+        self.stop(test, example)
+        doctest.DocTestRunner.report_success(self, out, test, example, got)
+
+    def report_failure(self, out, test, example, got):
+        """Record duration of a failing example"""
+        import doctest
+        self.stop(test, example)
+        doctest.DocTestRunner.report_failure(self, out, test, example, got)
+
+    def report_unexpected_exception(self, out, test, example, exc_info):
+        """Record duration of an example that raised an exception"""
+        import doctest
+        self.stop(test, example)
+        doctest.DocTestRunner.report_unexpected_exception(self, out, test,
+                                                          example, exc_info)
+
+
+def doctest_runner(optionflags, example_timeout=None, file_timeout=None):
+    """Create a :class:`TimedDocTestRunner`
+
+    :type optionflags: ``int``
+    :param optionflags: :mod:`doctest` option flags
+    :type example_timeout: ``float``
+    :param example_timeout: Seconds an example may run for
+    :type file_timeout: ``float``
+    :param file_timeout: Seconds all examples may run for
+    :rtype: `TimedDocTestRunner`
+    :return: Test runner
+
+    """
+    import doctest
+    runner_class = type("TimedDocTestRunner",
+                        (TimedDocTestRunner, doctest.DocTestRunner), {})
+    return runner_class(optionflags, example_timeout, file_timeout)
+
+
+@traced("test", 0)
+def test_file(filename, code, optionflags, extraglobs, lines=None,
+              timings=None, example_timeout=None, file_timeout=None):
+    """Run the :mod:`doctest` examples from a single file
+
+    :type filename: ``str``
+    :param filename: File to test
+    :type code: ``bool``
+    :param code: True if ``filename`` is a Python file, False for a text file
+    :type optionflags: ``int``
+    :param optionflags: :mod:`doctest` option flags
+    :type extraglobs: ``dict``
+    :param extraglobs: Extra globals for test execution
+    :type lines: ``set``
+    :param lines: Only run examples affected by changes to these lines
+    :type timings: ``list``
+    :param timings: List to extend with :attr:`TimedDocTestRunner.timings`
+    :type example_timeout: ``float``
+    :param example_timeout: Seconds an example may run for
+    :type file_timeout: ``float``
+    :param file_timeout: Seconds the file's examples may run for
+    :rtype: ``tuple`` of ``int``
+    :return: Number of failed and attempted tests
+
+    """
+    import doctest
+    if code:
+        # Metadata is read statically, so the module may not be loaded yet
+        __import__(module_name(filename))
+        testable = sys.modules[module_name(filename)]
+        if lines is not None:
+            tests = select_doctests(testable, lines, extraglobs)
+        else:
+            tests = doctest.DocTestFinder().find(testable,
+                                                 extraglobs=extraglobs)
+    else:
+        tests = None
+        if DOCUTILS and PYGMENTS:
+            try:
+                tests = [doctree_doctest(filename, extraglobs)]
+            except SystemExit:  # Unparseable, fall back to text search
+                pass
+        if tests is None:
+            globs = {"__name__": "__main__"}
+            globs.update(extraglobs)
+            tests = [doctest.DocTestParser().get_doctest(
+                open(filename).read(), globs, os.path.basename(filename),
+                filename, 0)]
+    runner = doctest_runner(optionflags, example_timeout, file_timeout)
+    timed_out = False
+    try:
+        for test in tests:
+            runner.run(test)
+    except DocTestTimeout:
+        print("    %s, remaining tests skipped" % sys.exc_info()[1])
+        timed_out = True
+    if timings is not None:
+        timings.extend(runner.timings)
+    fails, tests = runner.summarize(verbose=False)
+    if timed_out:
+        fails = max(fails, 1)
+    return fails, tests
+
+
+def source_digest():
+    """Digest the code tests can import
+
+    Covers the package, scripts and the :mod:`test` support modules, so a
+    change to any of them invalidates every cached result.
+
+    :rtype: ``str``
+    :return: Digest of source filenames and contents
+
+    """
+    files = ["%s.py" % i.__name__ for i in __pkg_data__.SCRIPTS]
+    for directory in (__pkg_data__.MODULE.__name__, "test"):
+        for root, dirs, names in os.walk(directory):
+            files.extend([os.path.join(root, name) for name in names
+                          if name.endswith(".py")])
+    digest = sha1()
+    for filename in sorted(files):
+        if os.path.isfile(filename):
+            digest.update(filename.encode("utf-8") + b"\0")
+            digest.update(open(filename, "rb").read())
+    return digest.hexdigest()
+
+
+def test_cache_key(filename, optionflags, extraglobs, sources):
+    """Generate a result cache key for a test file
+
+    :type filename: ``str``
+    :param filename: File to test
+    :type optionflags: ``int``
+    :param optionflags: :mod:`doctest` option flags
+    :type extraglobs: ``dict``
+    :param extraglobs: Extra globals for test execution
+    :type sources: ``str``
+    :param sources: :func:`source_digest` output
+    :rtype: ``str``
+    :return: Digest of file contents, importable code, test configuration
+        and interpreter
+
+    """
+    # Values are identified by name, as their reprs often contain addresses
+    globs = ["%s=%s" % (key, getattr(value, "__name__",
+                                     type(value).__name__))
+             for key, value in extraglobs.items()]
+    digest = sha1(open(filename, "rb").read())
+    digest.update(("%s %s %i %s %s" % (sys.version, filename, optionflags,
+                                       " ".join(sorted(globs)),
+                                       sources)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def read_test_cache(filename):
+    """Read cache of passing test files
+
+    :type filename: ``str``
+    :param filename: Cache file to read
+    :rtype: ``dict``
+    :return: Test counts keyed by :func:`test_cache_key` output
+
+    """
+    cache = {}
+    if os.path.isfile(filename):
+        for line in open(filename):
+            key, tests = line.split()
+            cache[key] = int(tests)
+    return cache
+
+
+def write_test_cache(filename, cache):
+    """Write cache of passing test files
+
+    :type filename: ``str``
+    :param filename: Cache file to write
+    :type cache: ``dict``
+    :param cache: Test counts keyed by :func:`test_cache_key` output
+
+    """
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    open(filename, "w").write("".join(["%s %i\n" % item
+                                       for item in sorted(cache.items())]))
+
+
+def test_extraglobs():
+    """Build mock objects to include for test framework
+
+    :rtype: ``dict``
+    :return: Extra globals for test execution
+
+    """
+    import test
+    extraglobs = {
+        "urllib": test.mock.urllib,
+    }
+    if hasattr(__pkg_data__, "TEST_EXTRAGLOBS"):
+        for key, value in __pkg_data__.TEST_EXTRAGLOBS.items():
+            if value:
+                extraglobs[key] = value
+            else:
+                extraglobs[key] = getattr(test.mock, key)
+    return extraglobs
+
+
+#: Test configuration for :mod:`multiprocessing` workers
+_WORKER_CONFIG = {}
+
+
+def _init_test_worker(code, optionflags, example_timeout, file_timeout):
+    """Store test configuration in a :mod:`multiprocessing` worker
+
+    Mock objects may not be picklable, and with the ``spawn`` or
+    ``forkserver`` start methods initialiser arguments are pickled.  The
+    extra globals are therefore rebuilt in the worker.
+
+    """
+    _WORKER_CONFIG.update(code=code, optionflags=optionflags,
+                          extraglobs=test_extraglobs(),
+                          example_timeout=example_timeout,
+                          file_timeout=file_timeout)
+
+
+def _test_file_worker(args):
+    """Run :func:`test_file` in a worker process, capturing its output
+
+    :type args: ``tuple``
+    :param args: File to test, and changed lines to select tests with
+    :rtype: ``tuple``
+    :return: Filename, failure count, test count, example timings and captured
+        output
+
+    """
+    filename, lines = args
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        timings = []
+        fails, tests = test_file(filename, lines=lines, timings=timings,
+                                 **_WORKER_CONFIG)
+        return filename, fails, tests, timings, sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+
 class MyTest(NoOptsCommand):
     """Abstract class for test command implementations"""
     #: `MyTest`'s option mapping
     user_options = [
         ('exit-on-fail', 'x',
          "exit on first failure"),
+        ('jobs=', 'j',
+         "number of parallel test processes, 0 for one per CPU"),
+        ('no-cache', None,
+         "rerun tests for files that passed previously"),
+        ('slowest=', None,
+         "number of slowest examples to report, 0 to disable"),
+        ('example-timeout=', None,
+         "seconds before an example is stopped, 0 for no limit"),
+        ('file-timeout=', None,
+         "seconds before a file's tests are stopped, 0 for no limit"),
     ]
-    boolean_options = ['exit-on-fail']
+    boolean_options = ['exit-on-fail', 'no-cache']
 
     def initialize_options(self):
         """Set default values for options"""
+        import doctest
         self.exit_on_fail = False
+        self.jobs = 1
+        self.no_cache = False
+        self.slowest = 10
+        self.example_timeout = 0
+        self.file_timeout = 0
+        #: Duration, filename, test name and line of examples run
+        self.timings = []
         self.doctest_opts = doctest.REPORT_UDIFF | doctest.NORMALIZE_WHITESPACE
         #: Mock objects to include for test framework
-        self.extraglobs = {
-            "urllib": test.mock.urllib,
-        }
-        if hasattr(__pkg_data__, "TEST_EXTRAGLOBS"):
-            for key, value in __pkg_data__.TEST_EXTRAGLOBS.items():
-                if value:
-                    self.extraglobs[key] = value
-                else:
-                    self.extraglobs[key] = getattr(test.mock, key)
+        self.extraglobs = test_extraglobs()
+
+    def finalize_options(self):
+        """Finalize, and test validity, of options"""
+        self.jobs = parse_jobs(self.jobs)
+        try:
+            self.slowest = int(self.slowest)
+        except ValueError:
+            raise DistutilsOptionError("Invalid example count %r"
+                                       % (self.slowest, ))
+        self.example_timeout = parse_timeout(self.example_timeout)
+        self.file_timeout = parse_timeout(self.file_timeout)
 
     def run(self):
         """Run doctest tests"""
-        if self.__class__.__name__ == "TestCode":
+        code = self.__class__.__name__ == "TestCode"
+        if code:
             files = glob("%s/*.py" % __pkg_data__.MODULE.__name__)
             files.extend(["%s.py" % i.__name__ for i in __pkg_data__.SCRIPTS])
-            test_func = doctest.testmod
             hook = "TestCode_run"
         else:
             files = ['README.rst', ] + glob("doc/*.rst")
-            test_func = doctest.testfile
             hook = "TestDoc_run"
+        files = sorted(files)
+        cache_file = os.path.join(CACHE_DIR, self.__class__.__name__)
+        cache = read_test_cache(cache_file)
+        sources = source_digest()
+        keys = dict([(filename, test_cache_key(filename, self.doctest_opts,
+                                               self.extraglobs, sources))
+                     for filename in files])
+        tot_cached = 0
+        changed = self.changed_lines(files)
+        if changed is None:
+            passed = {}
+        else:
+            files = [f for f in files if f in changed]
+            # Keep the results of files a partial run doesn't cover
+            passed = dict(cache)
+        if not self.no_cache:
+            for filename in [f for f in files if keys[f] in cache]:
+                self.print_header(filename, code)
+                print("    %i tests cached" % cache[keys[filename]])
+                passed[keys[filename]] = cache[keys[filename]]
+                tot_cached += cache[keys[filename]]
+                files.remove(filename)
+        if self.jobs > 1 and len(files) > 1:
+            pool = multiprocessing.Pool(min(self.jobs, len(files)),
+                                        _init_test_worker,
+                                        (code, self.doctest_opts,
+                                         self.example_timeout,
+                                         self.file_timeout))
+            results = self.parallel_results(pool, files, code, changed)
+        else:
+            pool = None
+            results = self.serial_results(files, code, changed)
         tot_fails = 0
         tot_tests = 0
-        for filename in sorted(files):
-            if self.__class__.__name__ == "TestCode":
-                print('  Testing python file %s' % filename)
-                module = os.path.splitext(filename)[0].replace("/", ".")
-                if module.endswith("__init__"):
-                    module = module[:-9]
-                testable = sys.modules[module]
-            else:
-                print('  Testing documentation file %s' % filename)
-                testable = filename
-            fails, tests = test_func(testable, optionflags=self.doctest_opts,
-                                     extraglobs=self.extraglobs)
-            print("    %i tests run, %i failed" % (tests, fails))
-            if self.exit_on_fail and not fails == 0:
-                sys.exit(1)
-            tot_fails += fails
-            tot_tests += tests
+        try:
+            for filename, fails, tests in results:
+                print("    %i tests run, %i failed" % (tests, fails))
+                if fails:
+                    if self.exit_on_fail:
+                        sys.exit(1)
+                # Partial runs can't be used to skip the file later
+                elif changed is None:
+                    passed[keys[filename]] = tests
+                tot_fails += fails
+                tot_tests += tests
+        finally:
+            if pool:
+                # Cancels outstanding work when exiting on first failure
+                pool.terminate()
+                pool.join()
+            if not self.dry_run:
+                write_test_cache(cache_file, passed)
         print("Total of %i tests run, %i failed" % (tot_tests, tot_fails))
+        if tot_cached:
+            print("Skipped %i tests from unchanged files" % tot_cached)
+        self.print_slowest()
         if hasattr(__pkg_data__, hook):
             getattr(__pkg_data__, hook)(self.dry_run, self.force)
 
+    @staticmethod
+    def print_header(filename, code):
+        """Display the file currently being tested
+
+        :type filename: ``str``
+        :param filename: File being tested
+        :type code: ``bool``
+        :param code: True if ``filename`` is a Python file
+
+        """
+        if code:
+            print('  Testing python file %s' % filename)
+        else:
+            print('  Testing documentation file %s' % filename)
+
+    def print_slowest(self):
+        """Display the slowest examples run"""
+        if not self.slowest or not self.timings:
+            return
+        print("Slowest examples:")
+        self.timings.sort(key=lambda timing: timing[0], reverse=True)
+        for duration, filename, name, line in self.timings[:self.slowest]:
+            print("    %8.3fs %s:%s %s" % (duration, filename, line or "?",
+                                          name))
+
+    def changed_lines(self, files):
+        """Find changed lines to select tests with
+
+        :type files: ``list``
+        :param files: Files to test
+        :rtype: ``dict``
+        :return: Sets of changed line numbers keyed by filename, or ``None`` to
+            run all tests
+
+        """
+        return None
+
+    def serial_results(self, files, code, changed=None):
+        """Run tests for each file in turn
+
+        :type files: ``list``
+        :param files: Files to test
+        :type code: ``bool``
+        :param code: True if ``files`` are Python files
+        :type changed: ``dict``
+        :param changed: Changed lines to select tests with
+        :rtype: ``generator``
+        :return: Filename, failure and test counts for each file
+
+        """
+        for filename in files:
+            self.print_header(filename, code)
+            fails, tests = test_file(filename, code, self.doctest_opts,
+                                     self.extraglobs,
+                                     changed and changed[filename],
+                                     self.timings, self.example_timeout,
+                                     self.file_timeout)
+            yield filename, fails, tests
+
+    def parallel_results(self, pool, files, code, changed=None):
+        """Run tests for files in a worker pool
+
+        Results are returned in the order they complete, with the output from
+        each file displayed as a block.
+
+        :type pool: ``multiprocessing.Pool``
+        :param pool: Worker pool to run tests in
+        :type files: ``list``
+        :param files: Files to test
+        :type code: ``bool``
+        :param code: True if ``files`` are Python files
+        :type changed: ``dict``
+        :param changed: Changed lines to select tests with
+        :rtype: ``generator``
+        :return: Filename, failure and test counts for each file
+
+        """
+        jobs = [(filename, changed and changed[filename])
+                for filename in files]
+        for filename, fails, tests, timings, output in \
+            pool.imap_unordered(_test_file_worker, jobs):
+            self.print_header(filename, code)
+            sys.stdout.write(output)
+            self.timings.extend(timings)
+            yield filename, fails, tests
+
 
 class TestDoc(MyTest):
     """Test documentation's code examples
@@ -527,21 +4211,436 @@ class TestCode(MyTest):
 
        :class:`MyTest`
 
+    .. attribute:: changed_since
+
+       Only run examples affected by changes since this revision
+
     """
     description = gen_desc(__doc__)
+    #: `TestCode`'s option mapping
+    user_options = MyTest.user_options + [
+        ('changed-since=', 'c',
+         "only run examples affected by changes since revision"),
+    ]
+
+    def initialize_options(self):
+        """Set default values for options"""
+        MyTest.initialize_options(self)
+        self.changed_since = None
+
+    def changed_lines(self, files):
+        """Find changed lines to select tests with
+
+        .. seealso::
+
+           :meth:`MyTest.changed_lines`
+
+        """
+        if not self.changed_since:
+            return None
+        return changed_lines(self.changed_since, files)
 #}
 
 
-def main():
-    # Force tests to be run, and documentation to be built, before creating a
-    # release.
-    if "sdist" in sys.argv:
-        for test in ("test_code", "test_doc"):
-            if not test in sys.argv:
-                sys.argv = [sys.argv[0], ] + [test, "-x"] + sys.argv[1:]
-        if not "build_doc" in sys.argv:
-            sys.argv.insert(1, "build_doc")
+#{ Watch utilities
+class InotifyWatcher(object):
+    """Report changes to files using Linux's inotify interface
+
+    Directories containing the watched files are monitored, so files created
+    after the watcher was started are also reported.
+
+    """
+    #: Events signalling a changed file; close after write, moves, creation
+    #: and deletion
+    MASK = 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+
+    def __init__(self, patterns):
+        """Initialise a new ``InotifyWatcher`` object
+
+        :type patterns: ``list``
+        :param patterns: Glob patterns of files to watch
+        :raise OSError: inotify is unavailable
+
+        """
+        self.patterns = patterns
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init"):
+            raise OSError("inotify unavailable")
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.dirs = {}
+        for directory in set([os.path.dirname(p) or "." for p in patterns]):
+            watch = libc.inotify_add_watch(self.fd, directory.encode("utf-8"),
+                                           self.MASK)
+            if watch < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(),
+                              "inotify_add_watch failed for %s" % directory)
+            self.dirs[watch] = directory
+
+    def changes(self, timeout=None):
+        """Wait for changes to watched files
+
+        :type timeout: ``float``
+        :param timeout: Seconds to wait for a change, ``None`` to wait forever
+        :rtype: ``set``
+        :return: Changed files, empty if ``timeout`` expired
+
+        """
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            watch, _, _, length = struct.unpack("iIII",
+                                                data[offset:offset + 16])
+            offset += 16
+            name = data[offset:offset + length].rstrip(b"\0").decode("utf-8")
+            offset += length
+            filename = os.path.normpath(os.path.join(self.dirs[watch], name))
+            for pattern in self.patterns:
+                if fnmatch.fnmatch(filename, pattern):
+                    changed.add(filename)
+        return changed
+
+
+class StatWatcher(object):
+    """Report changes to files by polling their status"""
+
+    def __init__(self, patterns, interval=1.0):
+        """Initialise a new ``StatWatcher`` object
+
+        :type patterns: ``list``
+        :param patterns: Glob patterns of files to watch
+        :type interval: ``float``
+        :param interval: Seconds between polls
+
+        """
+        self.patterns = patterns
+        self.interval = interval
+        self.state = self.scan()
+
+    def scan(self):
+        """Read the status of watched files
+
+        :rtype: ``dict``
+        :return: Modification time and size keyed by filename
+
+        """
+        state = {}
+        for pattern in self.patterns:
+            for filename in glob(pattern):
+                try:
+                    status = os.stat(filename)
+                except OSError:  # Removed while scanning
+                    continue
+                state[filename] = (status.st_mtime, status.st_size)
+        return state
+
+    def changes(self, timeout=None):
+        """Wait for changes to watched files
+
+        .. seealso::
+
+           :meth:`InotifyWatcher.changes`
 
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            state = self.scan()
+            changed = set([f for f in set(state) | set(self.state)
+                           if not state.get(f) == self.state.get(f)])
+            self.state = state
+            if changed:
+                return changed
+            if timeout is None:
+                time.sleep(self.interval)
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return changed
+                time.sleep(min(self.interval, remaining))
+
+
+def file_watcher(patterns, interval=1.0, poll=False):
+    """Create the most efficient watcher available
+
+    :type patterns: ``list``
+    :param patterns: Glob patterns of files to watch
+    :type interval: ``float``
+    :param interval: Seconds between polls, if polling is used
+    :type poll: ``bool``
+    :param poll: Always poll file status
+    :rtype: ``InotifyWatcher`` or ``StatWatcher``
+    :return: Watcher for ``patterns``
+
+    """
+    if CTYPES and not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(patterns)
+        except (AttributeError, OSError):
+            pass
+    return StatWatcher(patterns, interval)
+
+
+class Watch(NoOptsCommand):
+    """Rerun tests and rebuild documentation when files change
+
+    Only the examples and pages for changed files are processed, in a worker
+    forked from this warm process.
+
+    .. attribute:: delay
+
+       Seconds to wait for further changes before processing a change
+
+    .. attribute:: interval
+
+       Seconds between polls, if file status must be polled
+
+    .. attribute:: poll
+
+       Poll file status even when inotify is available
+
+    """
+    description = gen_desc(__doc__)
+    #: `Watch`'s option mapping
+    user_options = [
+        ('delay=', 'd',
+         "seconds to wait for further changes [0.2]"),
+        ('interval=', 'i',
+         "seconds between polls when polling file status [1.0]"),
+        ('poll', None,
+         "poll file status even when inotify is available"),
+    ]
+    #: `Watch` class' boolean options
+    boolean_options = ['poll']
+
+    def initialize_options(self):
+        """Set default values for options"""
+        self.delay = 0.2
+        self.interval = 1.0
+        self.poll = False
+
+    def finalize_options(self):
+        """Finalize, and test validity, of options"""
+        try:
+            self.delay = float(self.delay)
+            self.interval = float(self.interval)
+        except ValueError:
+            raise DistutilsOptionError("Invalid delay or interval")
+        #: Modules changed since watching started, reloaded in each worker
+        self.modified = set()
+
+    def run(self):
+        """Watch files until interrupted"""
+        patterns = ["%s/*.py" % __pkg_data__.MODULE.__name__, "README.rst",
+                    "doc/*.rst"]
+        patterns.extend(["%s.py" % i.__name__ for i in __pkg_data__.SCRIPTS])
+        watcher = file_watcher(patterns, self.interval, self.poll)
+        print("Watching %s with %s" % (", ".join(patterns),
+                                       watcher.__class__.__name__))
+        try:
+            while True:
+                changed = watcher.changes()
+                # Collect bursts of saves in to a single run
+                while True:
+                    more = watcher.changes(self.delay)
+                    if not more:
+                        break
+                    changed.update(more)
+                changed = sorted([f for f in changed if os.path.exists(f)])
+                if changed:
+                    self.modified.update([f for f in changed
+                                          if f.endswith(".py")])
+                    self.run_worker(changed)
+        except KeyboardInterrupt:
+            pass
+
+    def run_worker(self, files):
+        """Process changed files in a forked worker
+
+        :type files: ``list``
+        :param files: Changed files
+
+        """
+        if not hasattr(os, "fork"):
+            self.process(files)
+            return
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                try:
+                    self.process(files)
+                except (Exception, SystemExit):
+                    traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+    def process(self, files):
+        """Rerun tests and rebuild pages for changed files
+
+        :type files: ``list``
+        :param files: Changed files
+
+        """
+        for filename in sorted(self.modified):
+            name = module_name(filename)
+            if name in sys.modules:
+                reload(sys.modules[name])
+            else:
+                __import__(name)
+        test_code = self.distribution.get_command_obj("test_code")
+        test_code.ensure_finalized()
+        for filename in files:
+            code = filename.endswith(".py")
+            test_code.print_header(filename, code)
+            fails, tests = test_file(filename, code, test_code.doctest_opts,
+                                     test_code.extraglobs,
+                                     example_timeout=test_code.example_timeout,
+                                     file_timeout=test_code.file_timeout)
+            print("    %i tests run, %i failed" % (tests, fails))
+            if code or not DOCUTILS or not PYGMENTS:
+                continue
+            register_code_block()
+            deps = read_doc_deps()
+            for dest, writer_name in doc_outputs(filename):
+                print('Building file %s' % dest)
+                if render_doc(filename, dest, writer_name):
+                    deps[dest] = doc_inputs(filename)
+            write_doc_deps(deps)
+#}
+
+
+#{ Instrumentation
+def cpu_time():
+    """Fetch CPU time used by this process
+
+    :rtype: ``float``
+    :return: User and system CPU time in seconds
+
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+class TimedDistribution(Distribution):
+    """Distribution reporting the time spent in each command
+
+    ``--timings`` prints wall and CPU time for every command run, including
+    commands run by other commands, along with the SCM and
+    :command:`sphinx-build` subprocesses each started.  ``--profile`` also
+    writes a :mod:`cProfile` stats file per command, excluding time spent in
+    nested commands, for inspection with :mod:`pstats` or other standard tools.
+    ``--trace`` writes a Chrome trace event timeline, viewable in
+    ``chrome://tracing`` or Perfetto, with spans for commands, files, SCM
+    calls and archive steps in each process and thread.
+
+    """
+
+    global_options = Distribution.global_options + [
+        ('timings', None, "print time spent in each command"),
+        ('profile=', None, "directory to write per-command pstats files to"),
+        ('trace=', None, "file to write Chrome trace events to"),
+    ]
+
+    def __init__(self, attrs=None):
+        """Initialise a new `TimedDistribution` object
+
+        :type attrs: ``dict``
+        :param attrs: Distribution metadata and options
+
+        """
+        self.timings = 0
+        self.profile = None
+        self.trace = None
+        #: Timing records for commands run, in start order
+        self.command_times = []
+        #: Profilers for commands currently running, innermost last
+        self.profilers = []
+        Distribution.__init__(self, attrs)
+
+    def run_command(self, command):
+        """Run command, recording time spent in it
+
+        :type command: ``str``
+        :param command: Command name
+
+        """
+        if not (self.timings or self.profile or self.trace) \
+            or self.have_run.get(command):
+            Distribution.run_command(self, command)
+            return
+        depth = len(self.profilers)
+        if self.trace and not _TRACE:
+            start_trace(self.trace)
+        outer = self.profilers and self.profilers[-1]
+        profiler = None
+        if self.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            if outer:
+                outer.disable()
+        # Subprocesses are attributed to the innermost running command
+        parent = _PROCESS_LOG.get("records")
+        processes = _PROCESS_LOG["records"] = []
+        record = [depth, command, 0, 0, processes]
+        self.command_times.append(record)
+        self.profilers.append(profiler)
+        start, cpu = time.time(), cpu_time()
+        try:
+            if profiler:
+                profiler.runcall(Distribution.run_command, self, command)
+            else:
+                Distribution.run_command(self, command)
+        finally:
+            record[2:4] = [time.time() - start, cpu_time() - cpu]
+            self.profilers.pop()
+            _PROCESS_LOG["records"] = parent
+            if profiler:
+                if not os.path.isdir(self.profile):
+                    os.makedirs(self.profile)
+                profiler.dump_stats(os.path.join(self.profile,
+                                                 "%s.pstats" % command))
+                if outer:
+                    outer.enable()
+            trace_span(command, "command", start)
+            if depth == 0:
+                if self.trace:
+                    write_trace()
+                if self.timings or self.profile:
+                    self.print_timings()
+                self.command_times = []
+
+    def print_timings(self):
+        """Display timing records
+
+        Subprocesses are grouped by command and first argument, with counts
+        and total durations.
+
+        """
+        print("Command timings:")
+        for depth, command, wall, cpu, processes in self.command_times:
+            indent = "  " * (depth + 1)
+            print("%s%-*s %8.2fs wall %8.2fs CPU %4i subprocesses %8.2fs"
+                  % (indent, 20 - len(indent), command, wall, cpu,
+                     len(processes), sum([p[1] for p in processes])))
+            groups = {}
+            for name, duration in processes:
+                count, total = groups.get(name, (0, 0))
+                groups[name] = (count + 1, total + duration)
+            for name, (count, total) in sorted(groups.items()):
+                print("%s  %4i x %-22s %8.2fs" % (indent, count, name, total))
+#}
+
+
+def main():
     setup(
         name=__pkg_data__.MODULE.__name__,
         version=__pkg_data__.MODULE.__version__,
@@ -565,11 +4664,13 @@ def main():
         obsoletes=__pkg_data__.OBSOLETES,
         options={'sdist': {'formats': 'bztar'}},
         cmdclass={
-            'build_doc': BuildDoc, 'clean': MyClean, 'sdist': ScmSdist,
-            'snapshot': Snapshot, 'test_doc': TestDoc, 'test_code': TestCode,
+            'bench_compress': BenchCompress, 'build_doc': BuildDoc,
+            'clean': MyClean, 'sdist': ScmSdist, 'snapshot': Snapshot,
+            'test_doc': TestDoc, 'test_code': TestCode, 'watch': Watch,
         },
         install_requires=__pkg_data__.INSTALL_REQUIRES,
         entry_points=__pkg_data__.ENTRY_POINTS,
+        distclass=TimedDistribution,
     )
 
 if __name__ == "__main__":
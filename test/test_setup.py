@@ -0,0 +1,269 @@
+"""Tests for the project's ``setup.py``
+
+These are run from the project root, for example with
+``python -m unittest test.test_setup``.
+
+"""
+
+import doctest
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import setup
+
+#: Project root, where ``setup.py`` must be run from
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#: Modules ``setup.py`` should only import when a command needs them
+LAZY_MODULES = [
+    "bz2", "docutils", "doctest", "inspect", "lzma", "mmap",
+    "multiprocessing", "pygments", "socket", "sphinx", "subprocess",
+    "tarfile", "zipfile",
+]
+
+#: Script listing the modules imported by ``setup.py --help-commands``,
+#: beyond those :mod:`setuptools` imports to list commands itself
+STARTUP_SCRIPT = """
+import sys
+from setuptools import setup
+try:
+    setup(name="baseline", script_args=["--help-commands"])
+except SystemExit:
+    pass
+before = set(sys.modules)
+sys.argv = ["setup.py", "--help-commands"]
+try:
+    exec(compile(open("setup.py").read(), "setup.py", "exec"),
+         {"__name__": "__main__"})
+except SystemExit:
+    pass
+sys.stderr.write("\\nimported: %s\\n"
+                 % " ".join(sorted(set(sys.modules) - before)))
+"""
+
+
+class StartupTest(unittest.TestCase):
+    def test_lazy_imports(self):
+        process = subprocess.Popen([sys.executable, "-c", STARTUP_SCRIPT],
+                                   cwd=ROOT_DIR, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   universal_newlines=True)
+        output = process.communicate()[1]
+        self.assertEqual(process.returncode, 0)
+        imported = [line.split()[1:] for line in output.splitlines()
+                    if line.startswith("imported:")][0]
+        self.assertEqual([name for name in LAZY_MODULES if name in imported],
+                         [])
+
+
+#: Scripted :command:`hg serve --cmdserver pipe` stand in, advertising the
+#: capabilities given as its first argument.  Commands are echoed on the
+#: output channel, with special handling for:
+#:
+#: ``fail``: return code 255
+#: ``prompt``: request a line of input first
+#: ``warn``: write to the error channel first
+FAKE_HG_SERVER = r"""
+import struct
+import sys
+stdin = getattr(sys.stdin, "buffer", sys.stdin)
+stdout = getattr(sys.stdout, "buffer", sys.stdout)
+
+
+def send(channel, data):
+    stdout.write(struct.pack(">cI", channel, len(data)) + data)
+    stdout.flush()
+
+send(b"o", b"capabilities: " + sys.argv[1].encode() + b"\nencoding: UTF-8")
+while stdin.readline() == b"runcommand\n":
+    args = stdin.read(struct.unpack(">I", stdin.read(4))[0]).split(b"\0")
+    if args[0] == b"prompt":
+        stdout.write(struct.pack(">cI", b"L", 4096))
+        stdout.flush()
+        if not struct.unpack(">I", stdin.read(4))[0] == 0:
+            sys.exit(1)
+    elif args[0] == b"warn":
+        send(b"e", b"warning\n")
+    send(b"o", b" ".join(args) + b"\n")
+    send(b"r", struct.pack(">i", args[0] == b"fail" and 255 or 0))
+"""
+
+
+class HgCommandServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = setup.HgCommandServer(
+            [sys.executable, "-c", FAKE_HG_SERVER, "getencoding runcommand"])
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_runcommand(self):
+        self.assertEqual(self.server.runcommand(["log", "-r", "tip"]),
+                         (0, "log -r tip\n"))
+        # The server is reused for later commands
+        self.assertEqual(self.server.runcommand(["status"]), (0, "status\n"))
+
+    def test_returncode(self):
+        self.assertEqual(self.server.runcommand(["fail"]), (255, "fail\n"))
+
+    def test_stdout(self):
+        output = io.StringIO()
+        self.assertEqual(self.server.runcommand(["log"], output), (0, ""))
+        self.assertEqual(output.getvalue(), "log\n")
+
+    def test_input_request(self):
+        self.assertEqual(self.server.runcommand(["prompt"]),
+                         (0, "prompt\n"))
+
+    def test_error_channel(self):
+        stderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            self.assertEqual(self.server.runcommand(["warn"]),
+                             (0, "warn\n"))
+            self.assertEqual(sys.stderr.getvalue(), "warning\n")
+        finally:
+            sys.stderr = stderr
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, setup.HgCommandServer,
+                          [sys.executable, "-c", FAKE_HG_SERVER,
+                           "getencoding"])
+
+
+def run(*args):
+    """Run a command, failing the test if it fails
+
+    :type args: ``list``
+    :param args: Command line
+
+    """
+    process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise AssertionError("%r failed: %s" % (args, output))
+
+
+def have_command(name):
+    """Check whether a command can be run
+
+    :type name: ``str``
+    :param name: Command to check
+    :rtype: ``bool``
+    :return: True if ``name --version`` succeeds
+
+    """
+    try:
+        run(name, "--version")
+    except (AssertionError, OSError):
+        return False
+    return True
+
+
+class ChangeLogMixin(object):
+    """Tests for :func:`setup.write_changelog`, in a scratch repository"""
+    #: SCM type to test
+    scm = None
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.pkg_scm = setup.__pkg_data__.SCM
+        setup.__pkg_data__.SCM = self.scm
+        self.hg_server = setup._HG_SERVER.copy()
+        # The command server is tied to the repository it was started in
+        setup._HG_SERVER["server"] = None
+        self.stdout = sys.stdout
+        sys.stdout = setup.StringIO()
+        self.init()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        setup._HG_SERVER.clear()
+        setup._HG_SERVER.update(self.hg_server)
+        setup.__pkg_data__.SCM = self.pkg_scm
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def commit(self, filename, message):
+        """Commit a new file
+
+        :type filename: ``str``
+        :param filename: File to create
+        :type message: ``str``
+        :param message: Commit message
+
+        """
+        open(filename, "w").write(message)
+        self.add(filename)
+        self.commit_all(message)
+
+    def test_new_changes(self):
+        self.commit("a", "First change")
+        setup.write_changelog("ChangeLog")
+        self.commit("b", "Second change")
+        setup.write_changelog("ChangeLog")
+        self.assertTrue("Updating ChangeLog" in sys.stdout.getvalue())
+        changelog = open("ChangeLog").read()
+        self.assertTrue(changelog.index("Second change")
+                        < changelog.index("First change"))
+
+    def test_rewritten_history(self):
+        self.commit("a", "First change")
+        self.commit("b", "Dropped change")
+        setup.write_changelog("ChangeLog")
+        self.reset_to_parent()
+        self.commit("c", "Replacement change")
+        setup.write_changelog("ChangeLog")
+        # The recorded revision is no longer an ancestor, so rebuild in full
+        self.assertFalse("Updating ChangeLog" in sys.stdout.getvalue())
+        self.assertTrue("Replacement change" in open("ChangeLog").read())
+
+
+@unittest.skipUnless(have_command("git"), "git unavailable")
+class GitChangeLogTest(ChangeLogMixin, unittest.TestCase):
+    scm = "git"
+
+    def init(self):
+        run("git", "init", "-q")
+        run("git", "config", "user.name", "Test")
+        run("git", "config", "user.email", "test@example.com")
+
+    def add(self, filename):
+        run("git", "add", filename)
+
+    def commit_all(self, message):
+        run("git", "commit", "-q", "-m", message)
+
+    def reset_to_parent(self):
+        run("git", "reset", "-q", "--hard", "HEAD^")
+
+
+@unittest.skipUnless(have_command("hg"), "hg unavailable")
+class HgChangeLogTest(ChangeLogMixin, unittest.TestCase):
+    scm = "hg"
+
+    def init(self):
+        run("hg", "init")
+
+    def add(self, filename):
+        run("hg", "add", filename)
+
+    def commit_all(self, message):
+        run("hg", "commit", "-u", "Test <test@example.com>", "-m", message)
+
+    def reset_to_parent(self):
+        run("hg", "update", "-q", "-r", "p1(.)")
+
+
+def load_tests(loader, tests, pattern):
+    """Include the :mod:`doctest` examples from ``setup.py``"""
+    tests.addTests(doctest.DocTestSuite(setup))
+    return tests